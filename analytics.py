@@ -0,0 +1,158 @@
+"""
+Risk and performance analytics of a portfolio's current holdings,
+The daily closes of every held symbol and of the benchmark are fetched with
+one bulk history request (or read from the local price history) into an
+aligned date x symbol matrix, which is memoized for the trading day, and
+every measure is computed with NumPy over that matrix.
+"""
+import os
+import threading
+from datetime import date, timedelta
+from holdings import np
+from providers import QUOTE_SOURCE
+
+# Symbol the beta of portfolios is measured against.
+BENCHMARK_SYMBOL = os.getenv("BENCHMARK_SYMBOL", "SPY")
+# Number of calendar days of history the analytics cover.
+ANALYTICS_DAYS = int(os.getenv("ANALYTICS_DAYS", "365"))
+# Confidence level of the historical value at risk.
+VAR_CONFIDENCE = float(os.getenv("VAR_CONFIDENCE", "0.95"))
+TRADING_DAYS = 252
+
+_matrices = {}
+_matrices_lock = threading.Lock()
+
+
+def _download_matrix(symbols, start):
+    """
+    Fetches the daily closes of the symbols since `start` with one grouped
+    yfinance request and returns the dates and the aligned close matrix.
+    """
+    import pandas
+    from history import _download
+    frames = _download(symbols, start=start)
+    if not frames:
+        return np.empty(0, dtype="datetime64[D]"), np.empty((0, len(symbols)))
+    closes = pandas.concat(
+        [frame.xs("Close", axis=1, level=1) for frame in frames], axis=1)
+    closes = closes.loc[:, ~closes.columns.duplicated()]
+    closes = closes.reindex(columns=symbols).sort_index()
+    dates = closes.index.values.astype("datetime64[D]")
+    return dates, closes.to_numpy(dtype=np.float64)
+
+
+def close_matrix(symbols, day=None):
+    """
+    Returns the trading days and the matrix of daily closes (one column per
+    symbol, NaN when unknown) over the last ANALYTICS_DAYS days,
+    Matrices are memoized per set of symbols for the day, so every report of
+    the same holdings on the same day reuses one request.
+    """
+    day = day or date.today()
+    key = (tuple(symbols), day)
+    with _matrices_lock:
+        if key in _matrices:
+            return _matrices[key]
+    start = day - timedelta(days=ANALYTICS_DAYS)
+    if QUOTE_SOURCE == "history":
+        from history import get_history_store
+        result = get_history_store().history(symbols, start, day)
+    else:
+        result = _download_matrix(list(symbols), start)
+    with _matrices_lock:
+        # Matrices of earlier days are not needed anymore.
+        for old in [old for old in _matrices if old[1] != day]:
+            del _matrices[old]
+        _matrices[key] = result
+    return result
+
+
+def fill_gaps(matrix):
+    """
+    Returns a copy of the matrix where every missing or non-positive close
+    is replaced by the previous close of the symbol, or by its first close
+    at the start.
+    """
+    matrix = np.array(matrix, dtype=np.float64)
+    matrix[~(matrix > 0)] = np.nan
+    rows = np.arange(len(matrix))[:, None]
+    for values in (matrix, matrix[::-1]):
+        known = np.where(np.isnan(values), 0, rows)
+        np.maximum.accumulate(known, axis=0, out=known)
+        values[:] = values[known, np.arange(values.shape[1])]
+    return matrix
+
+
+def analyze(stock, benchmark=BENCHMARK_SYMBOL, confidence=VAR_CONFIDENCE,
+            day=None):
+    """
+    Computes the analytics of the holdings (symbol -> quantity mapping),
+    Returns a dictionary with the daily returns, the annualized volatility,
+    the maximum drawdown, the beta against the benchmark, the historical
+    value at risk of one day at the given confidence, and the held symbols
+    without any price history, or None when nothing could be priced.
+    """
+    held = {symbol: quantity for symbol, quantity in stock.items()
+            if quantity > 0}
+    symbols = tuple(sorted(held)) + (benchmark,)
+    dates, matrix = close_matrix(symbols, day)
+    if len(dates) < 2:
+        return None
+    matrix = fill_gaps(matrix)
+    priced = ~np.isnan(matrix[0])
+    quantities = np.array([held[symbol] for symbol in symbols[:-1]] + [0],
+                          dtype=np.float64)
+    quantities[~priced] = 0
+    if not quantities.any():
+        return None
+    values = np.nan_to_num(matrix) @ quantities
+    returns = np.diff(values) / values[:-1]
+    peaks = np.maximum.accumulate(values)
+    beta = None
+    if priced[-1]:
+        benchmark_returns = np.diff(matrix[:, -1]) / matrix[:-1, -1]
+        variance = benchmark_returns.var()
+        if variance > 0:
+            beta = float(np.cov(returns, benchmark_returns, bias=True)[0, 1] /
+                         variance)
+    return {
+        "start": str(dates[0]),
+        "end": str(dates[-1]),
+        "value": float(values[-1]),
+        "returns": returns,
+        "total_return": float(values[-1] / values[0] - 1),
+        "volatility": float(returns.std() * np.sqrt(TRADING_DAYS)),
+        "max_drawdown": float((values / peaks - 1).min()),
+        "beta": beta,
+        "value_at_risk": float(-np.percentile(returns,
+                                              (1 - confidence) * 100) *
+                               values[-1]),
+        "missing": sorted(symbol for symbol, known
+                          in zip(symbols[:-1], priced) if not known)
+    }
+
+
+def print_report(stock, benchmark=BENCHMARK_SYMBOL,
+                 confidence=VAR_CONFIDENCE):
+    """
+    Prints the analytics of the holdings for the analytics menu option.
+    """
+    report = analyze(stock, benchmark, confidence)
+    if report is None:
+        print("There is not enough price history to analyze your stocks.")
+        return
+    print(f"Analytics of your stocks from {report['start']} to "
+          f"{report['end']} (current value {report['value']:.2f}):")
+    print(f"- Return: {report['total_return']:.2%}, average daily return: "
+          f"{report['returns'].mean():.3%}")
+    print(f"- Annualized volatility: {report['volatility']:.2%}")
+    print(f"- Maximum drawdown: {report['max_drawdown']:.2%}")
+    if report["beta"] is None:
+        print(f"- Beta: not available, {benchmark} has no price history")
+    else:
+        print(f"- Beta against {benchmark}: {report['beta']:.2f}")
+    print(f"- 1-day value at risk ({confidence:.0%}): "
+          f"{report['value_at_risk']:.2f}")
+    if report["missing"]:
+        print(f"* {', '.join(report['missing'])} have no price history and "
+              f"are left out.")
@@ -0,0 +1,214 @@
+"""
+Headless batch mode: applies a file of operations to many accounts without
+the interactive menu,
+- The order file is CSV with a header or JSON lines, each operation has an
+  `account`, an `action` (buy, sell, deposit or withdraw), and a `symbol`
+  and `quantity` for trades or an `amount` for deposits and withdrawals,
+- Operations are read in blocks, the prices of all trades of a block are
+  fetched with one bulk quote request,
+- Every touched account is saved once at the end of the run,
+- One result line is written per operation, followed by the throughput.
+
+Usage: python run.py --batch ORDERS [--report REPORT]
+"""
+import contextlib
+import csv
+import io
+import json
+import sys
+import time
+from profiling import profiler
+from quotes import price_symbols
+from storage import get_store, write_behind
+from symbols import get_symbol_index
+import run
+
+# Number of operations whose prices are fetched together.
+BATCH_BLOCK_SIZE = 1000
+ACTIONS = ("buy", "sell", "deposit", "withdraw")
+# Profiler scope of each action, named like the menu actions.
+PROFILE_ACTIONS = {"buy": "buy", "sell": "sell", "deposit": "increase",
+                   "withdraw": "withdraw"}
+REPORT_FIELDS = ["line", "account", "action", "symbol", "quantity", "amount",
+                 "status", "message"]
+
+
+def read_orders(file):
+    """
+    Yields (line number, operation dictionary) for every operation of an
+    open order file, JSON lines are recognised by their leading brace.
+    """
+    first = file.readline()
+    if first.lstrip().startswith("{"):
+        yield 1, json.loads(first)
+        for number, line in enumerate(file, 2):
+            if line.strip():
+                yield number, json.loads(line)
+    else:
+        header = next(csv.reader([first]))
+        for number, row in enumerate(csv.reader(file), 2):
+            if row:
+                yield number, dict(zip(header, row))
+
+
+def _blocks(orders, size):
+    block = []
+    for order in orders:
+        block.append(order)
+        if len(block) == size:
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+class BatchRun:
+    def __init__(self, report):
+        """
+        Applies operations and writes one result per operation to the
+        `report` CSV writer.
+        """
+        self.report = report
+        self.symbols = get_symbol_index()
+        self.portfolios = {}
+        self.succeeded = 0
+        self.failed = 0
+
+    def validate(self, order):
+        """
+        Normalises an operation in place and returns an error message, or
+        None when it is valid.
+        """
+        try:
+            order["account"] = int(order["account"])
+        except (KeyError, TypeError, ValueError):
+            return "The account id is invalid!"
+        order["action"] = str(order.get("action", "")).strip().lower()
+        if order["action"] not in ACTIONS:
+            return "The action is invalid!"
+        field = "quantity" if order["action"] in ("buy", "sell") else "amount"
+        try:
+            order[field] = float(order.get(field) or order.get("quantity"))
+        except (TypeError, ValueError):
+            return "The value you entered is invalid!"
+        if order[field] <= 0:
+            return "The number you entered needs to be greater than zero!"
+        if field == "quantity":
+            order["symbol"] = str(order.get("symbol", "")).strip()
+            if order["symbol"] not in self.symbols:
+                return "The symbol you entered is invalid!"
+        return None
+
+    def portfolio(self, account_id):
+        """
+        Returns the loaded portfolio of the account, loading it the first
+        time with saving turned off, or None for an unknown account.
+        """
+        if account_id not in self.portfolios:
+            with profiler.scope("login"):
+                user = get_store().get(account_id)
+                if user is None:
+                    return None
+                portfolio = run.portfolio_from_record(user)
+            portfolio.autosave = False
+            self.portfolios[account_id] = portfolio
+        return self.portfolios[account_id]
+
+    def apply(self, order, prices):
+        """
+        Applies one valid operation through the Portfolio methods and
+        returns (success, message), the message is what the method printed.
+        """
+        portfolio = self.portfolio(order["account"])
+        if portfolio is None:
+            return False, "The account does not exist!"
+        action = order["action"]
+        if action in ("buy", "sell") and order["symbol"] not in prices:
+            return False, f"No live price for {order['symbol']}."
+        output = io.StringIO()
+        scope = profiler.scope(PROFILE_ACTIONS[action])
+        with contextlib.redirect_stdout(output), scope:
+            if action == "buy":
+                done = portfolio.buy_stock(order["symbol"], order["quantity"],
+                                           prices[order["symbol"]])
+            elif action == "sell":
+                done = portfolio.sell_stock(order["symbol"],
+                                            order["quantity"],
+                                            prices[order["symbol"]])
+            elif action == "deposit":
+                done = portfolio.increase_investment(order["amount"])
+            else:
+                done = portfolio.withdraw(order["amount"])
+        return done, output.getvalue().strip()
+
+    def run_block(self, block):
+        """
+        Validates a block of operations, prices all its trades with one bulk
+        request and applies them in file order.
+        """
+        errors = {number: self.validate(order) for number, order in block}
+        symbols = {order["symbol"] for number, order in block
+                   if errors[number] is None and
+                   order["action"] in ("buy", "sell")}
+        prices = {}
+        if symbols:
+            prices, stale, unavailable = price_symbols(symbols, fresh=True)
+            for symbol in stale:
+                # Trades are only made at live prices.
+                del prices[symbol]
+        for number, order in block:
+            if errors[number] is None:
+                done, message = self.apply(order, prices)
+            else:
+                done, message = False, errors[number]
+            if done:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+            self.report.writerow({
+                "line": number,
+                "account": order.get("account"),
+                "action": order.get("action"),
+                "symbol": order.get("symbol", ""),
+                "quantity": order.get("quantity", ""),
+                "amount": order.get("amount", ""),
+                "status": "ok" if done else "error",
+                "message": message
+            })
+
+    def save(self):
+        """
+        Saves every touched account with one batched compare-and-swap write,
+        accounts changed meanwhile by a session get the batch's operations
+        merged into them.
+        """
+        for portfolio in self.portfolios.values():
+            portfolio.autosave = True
+            portfolio.save_update()
+        write_behind.flush()
+
+
+def run_batch(orders_path, report_path=None):
+    """
+    Applies the order file and prints the throughput,
+    Results go to `report_path` as CSV, or to standard output.
+    """
+    start = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        orders = stack.enter_context(open(orders_path, "r", newline=""))
+        if report_path:
+            output = stack.enter_context(open(report_path, "w", newline=""))
+        else:
+            output = sys.stdout
+        report = csv.DictWriter(output, fieldnames=REPORT_FIELDS)
+        report.writeheader()
+        batch = BatchRun(report)
+        for block in _blocks(read_orders(orders), BATCH_BLOCK_SIZE):
+            batch.run_block(block)
+        batch.save()
+    elapsed = time.perf_counter() - start
+    total = batch.succeeded + batch.failed
+    print(f"{total} operations ({batch.succeeded} ok, {batch.failed} "
+          f"failed) in {elapsed:.2f} s: {total / max(elapsed, 1e-9):.0f} "
+          f"operations per second", file=sys.stderr)
+    return batch
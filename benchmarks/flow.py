@@ -0,0 +1,331 @@
+"""
+End-to-end benchmark of the menu operations against local stand-ins: a fake
+Gist API served over HTTP on localhost and a fake quote provider, so no
+network or credentials are needed.
+
+For every number of accounts and of positions of the benchmarked account it
+times login (load_portfolio), status (full re-pricing), buy, sell, deposit,
+withdraw and a scripted main() session, with DURABILITY=strict so every
+operation makes its own writes. Each result is one JSON line with the
+p50/p95/p99 latency and the Gist calls, Gist bytes and quote calls per
+operation, tagged with the git commit so runs of two versions can be
+compared.
+
+Usage: python benchmarks/flow.py [--users 1,100,10000] [--positions 1,10,100]
+                                 [--repeat 20] [--output results.jsonl]
+"""
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+
+class FakeGist:
+    """
+    In-memory Gist with the parts of the API the GistStore uses: GET with
+    ETag / If-None-Match and PATCH of files, a null file deleting it,
+    counting calls and bytes.
+    """
+    def __init__(self):
+        self.files = {}
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.bytes = 0
+        self._render()
+
+    def _render(self):
+        self.body = json.dumps({"files": {
+            name: {"content": content, "truncated": False}
+            for name, content in self.files.items()}}).encode()
+        self.etag = f'"{hashlib.md5(self.body).hexdigest()}"'
+
+    def reset(self, creds):
+        with self.lock:
+            self.files = {f"account-{user['id']}.json": json.dumps(user)
+                          for user in creds}
+            self._render()
+
+    def handler(self):
+        gist = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *arguments):
+                pass
+
+            def reply(self, status, body=b""):
+                gist.calls += 1
+                gist.bytes += len(body)
+                self.send_response(status)
+                self.send_header("ETag", gist.etag)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                with gist.lock:
+                    if self.headers.get("If-None-Match") == gist.etag:
+                        self.reply(304)
+                    else:
+                        self.reply(200, gist.body)
+
+            def do_PATCH(self):
+                length = int(self.headers["Content-Length"])
+                payload = self.rfile.read(length)
+                with gist.lock:
+                    gist.bytes += length
+                    for name, file in json.loads(payload)["files"].items():
+                        if file is None:
+                            gist.files.pop(name, None)
+                        else:
+                            gist.files[name] = file["content"]
+                    gist._render()
+                    self.reply(200, gist.body)
+
+        return Handler
+
+
+class FakeQuotes:
+    """
+    Quote provider returning a fixed price per symbol, counting calls and
+    the bytes of the prices it returns.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.bytes = 0
+
+    def price(self, symbol):
+        return float(10 + int(hashlib.md5(symbol.encode()).hexdigest(), 16)
+                     % 490)
+
+    def fetch(self, symbol):
+        self.calls += 1
+        self.bytes += len(json.dumps({symbol: self.price(symbol)}))
+        return self.price(symbol)
+
+    def fetch_many(self, symbols):
+        self.calls += 1
+        closes = {symbol: self.price(symbol) for symbol in symbols}
+        self.bytes += len(json.dumps(closes))
+        return closes
+
+
+class ScriptedTerminal:
+    """
+    Stands in for sys.stdin and sys.stdout of a main() session: input lines
+    and key presses are taken in order from a script, output is discarded,
+    EOFError ends the session once the script is used up.
+    """
+    def __init__(self, script):
+        self.script = list(script)
+
+    def _next(self):
+        if not self.script:
+            raise EOFError
+        return self.script.pop(0)
+
+    def readline(self):
+        return self._next() + "\n"
+
+    def get_key(self):
+        return self._next()
+
+    def write(self, text):
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def clear_screen(self):
+        pass
+
+
+def session_script(account_id, password, symbol):
+    """
+    Returns the inputs of a session that logs in, buys, sells, deposits,
+    withdraws, refreshes the status and quits.
+    """
+    return [
+        "1", str(account_id), password, "x",
+        "1", symbol, "2", "x",
+        "2", symbol, "1", "x",
+        "3", "50", "x",
+        "4", "20", "x",
+        "5", "x",
+        "0", "x"
+    ]
+
+
+def make_creds(users, positions, symbols, password):
+    """
+    Returns `users` accounts, the first one holding `positions` stocks and
+    every other one three.
+    """
+    creds = []
+    for account_id in range(1, users + 1):
+        count = positions if account_id == 1 else 3
+        stock = {symbols[(account_id + n) % len(symbols)]: 5.0
+                 for n in range(count)}
+        creds.append({"id": account_id, "password": password,
+                      "stock": stock, "investment": 1e9,
+                      "account_value": 1e9, "buying_power": 1e9,
+                      "creds": "creds.json"})
+    return creds
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def measure(name, operation, repeat, gist, quotes):
+    """
+    Runs the operation `repeat` times and returns its result line.
+    """
+    latencies = []
+    gist_calls, gist_bytes = gist.calls, gist.bytes
+    quote_calls, quote_bytes = quotes.calls, quotes.bytes
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            operation()
+            latencies.append(time.perf_counter() - start)
+    return {
+        "operation": name,
+        "samples": repeat,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "gist_calls": (gist.calls - gist_calls) / repeat,
+        "gist_bytes": (gist.bytes - gist_bytes) / repeat,
+        "quote_calls": (quotes.calls - quote_calls) / repeat,
+        "quote_bytes": (quotes.bytes - quote_bytes) / repeat
+    }
+
+
+def run_point(run, gist, quotes, users, positions, repeat):
+    """
+    Benchmarks every operation for one number of accounts and positions.
+    """
+    import storage
+    from quotes import quote_cache
+    from symbols import get_symbol_index
+    symbols = list(get_symbol_index())
+    password = "secret"
+    gist.reset(make_creds(users, positions, symbols, password))
+    quote_cache.clear()
+    with contextlib.redirect_stdout(io.StringIO()):
+        portfolio = run.load_portfolio(1, password)[1]
+    symbol = next(iter(portfolio.stock))
+
+    def login():
+        # A login starts a process, with a new store and no cached Gist.
+        storage._store = None
+        run.load_portfolio(1, password)
+
+    def status():
+        quote_cache.clear()
+        portfolio.print_status(refresh=True)
+
+    def session():
+        terminal = ScriptedTerminal(session_script(1, password, symbol))
+        stdin, stdout = sys.stdin, sys.stdout
+        sys.stdin = sys.stdout = terminal
+        try:
+            run.main()
+        except EOFError:
+            pass
+        finally:
+            sys.stdin, sys.stdout = stdin, stdout
+
+    operations = [
+        ("login", login),
+        ("status", status),
+        ("buy", lambda: portfolio.buy_stock(symbol, 1)),
+        ("sell", lambda: portfolio.sell_stock(symbol, 1)),
+        ("deposit", lambda: portfolio.increase_investment(10)),
+        ("withdraw", lambda: portfolio.withdraw(10)),
+        ("session", session)
+    ]
+    return [dict(measure(name, operation, repeat, gist, quotes),
+                 users=users, positions=positions)
+            for name, operation in operations]
+
+
+def version():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def numbers(text):
+    return [int(value) for value in text.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--users", type=numbers, default=[1, 100, 10000],
+                        help="comma-separated account counts, up to 100000")
+    parser.add_argument("--positions", type=numbers, default=[1, 10, 100],
+                        help="comma-separated position counts, up to 1000")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--output", help="JSON lines file, default stdout")
+    arguments = parser.parse_args()
+
+    gist = FakeGist()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), gist.handler())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    # The stand-ins are configured before the application modules read
+    # their settings.
+    os.environ.update({
+        "GIST_API_URL": f"http://127.0.0.1:{server.server_address[1]}",
+        "GIST_ID": "benchmark",
+        "GITHUB_TOKEN": "benchmark",
+        "STORAGE_BACKEND": "gist",
+        "DURABILITY": "strict",
+        "QUOTE_REFRESH_INTERVAL": "0"
+    })
+    os.environ.pop("LEDGER_DIR", None)
+    import providers
+    import run
+    quotes = FakeQuotes()
+    providers.set_quote_provider(quotes)
+
+    metadata = {"benchmark": "flow", "version": version(),
+                "python": platform.python_version()}
+    if arguments.output:
+        output = open(arguments.output, "w")
+    else:
+        output = contextlib.nullcontext(sys.stdout)
+    with output as output:
+        for users in arguments.users:
+            for positions in arguments.positions:
+                for result in run_point(run, gist, quotes, users, positions,
+                                        arguments.repeat):
+                    output.write(json.dumps(dict(metadata, **result)) + "\n")
+                    output.flush()
+                    print(f"{users:>6} users {positions:>4} positions "
+                          f"{result['operation']:>8}: "
+                          f"p50 {result['p50_ms']:8.2f} ms, "
+                          f"p99 {result['p99_ms']:8.2f} ms, "
+                          f"{result['gist_calls']:.1f} gist calls "
+                          f"({result['gist_bytes'] / 1024:.1f} KiB), "
+                          f"{result['quote_calls']:.1f} quote calls",
+                          file=sys.stderr)
+    server.shutdown()
@@ -0,0 +1,75 @@
+"""
+Measures with tracemalloc the memory held per loaded portfolio, as in a
+server process with many logged-in sessions: random account records are
+decoded from their stored JSON one at a time, as the SQLite and files
+backends do, and turned into portfolios with portfolio_from_record. The
+records are dropped once loaded, only the portfolios are kept.
+
+Usage: python benchmarks/memory.py [accounts] [positions per account]
+                                   [orders per account]
+"""
+import gc
+import json
+import os
+import random
+import sys
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+os.environ.pop("LEDGER_DIR", None)
+
+import numpy  # noqa: E402,F401
+import run  # noqa: E402
+from symbols import get_symbol_index  # noqa: E402
+
+
+def stored_records(accounts, positions, orders, symbols):
+    """
+    Yields the JSON text of random account records.
+    """
+    for number in range(1, accounts + 1):
+        held = random.sample(symbols, positions)
+        yield json.dumps({
+            "id": number,
+            "password": f"secret{number}",
+            "stock": {symbol: float(random.randint(1, 100))
+                      for symbol in held},
+            "investment": 10000.0,
+            "account_value": 10000.0,
+            "buying_power": 5000.0,
+            "creds": "creds.json",
+            "ledger_seq": 0,
+            "version": 1,
+            "orders": [{"id": order + 1, "side": "buy", "kind": "limit",
+                        "symbol": random.choice(held), "quantity": 1.0,
+                        "trigger": 10.0} for order in range(orders)]
+        })
+
+
+if __name__ == "__main__":
+    accounts = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    positions = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    orders = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    random.seed(0)
+    symbols = list(get_symbol_index())
+    texts = list(stored_records(accounts, positions, orders, symbols))
+    # Loads the lazily imported modules before measuring.
+    run.portfolio_from_record(json.loads(texts[0])).to_record()
+
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    portfolios = [run.portfolio_from_record(json.loads(text))
+                  for text in texts]
+    gc.collect()
+    loaded = tracemalloc.get_traced_memory()[0] - start
+    records = [portfolio.to_record() for portfolio in portfolios]
+    serialized = tracemalloc.get_traced_memory()[0] - start - loaded
+    tracemalloc.stop()
+
+    print(f"accounts: {accounts}, positions: {positions}, orders: {orders}")
+    print(f"loaded portfolio: {loaded / accounts:.0f} bytes per account")
+    print(f"record from to_record: {serialized / accounts:.0f} bytes per "
+          f"account")
@@ -0,0 +1,97 @@
+"""
+Times the order book on many open limit and stop orders: random orders are
+rested around a starting price per symbol, then prices take a random walk
+and every new price is matched against the book, then the triggered orders
+are filled through their portfolios. The same walk is matched by scanning
+every open order of the symbol, for comparison.
+
+Usage: python benchmarks/orders.py [orders] [quotes] [symbols]
+"""
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from orders import KINDS, SIDES, order_book  # noqa: E402
+from symbols import get_symbol_index  # noqa: E402
+import run  # noqa: E402
+
+ACCOUNTS = 1000
+
+
+def scan(orders, symbol, price):
+    """
+    Matches by testing every open order of the symbol.
+    """
+    triggered = [order for order in orders[symbol]
+                 if order.triggered_by(price)]
+    for order in triggered:
+        orders[symbol].remove(order)
+    return triggered
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    updates = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    symbol_count = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+    random.seed(0)
+    symbols = list(get_symbol_index())[:symbol_count]
+    start_prices = {symbol: random.uniform(10, 500) for symbol in symbols}
+    portfolios = []
+    for number in range(1, ACCOUNTS + 1):
+        portfolio = run.Portfolio(1e12, "benchmark", number, save=False)
+        portfolio.autosave = False
+        for symbol in symbols:
+            portfolio.stock[symbol] = 1e6
+        portfolios.append(portfolio)
+
+    start = time.perf_counter()
+    for _ in range(count):
+        symbol = random.choice(symbols)
+        trigger = round(start_prices[symbol] * random.uniform(0.8, 1.2), 2)
+        portfolio = random.choice(portfolios)
+        order = run.Order(portfolio.next_order, random.choice(SIDES),
+                          random.choice(KINDS), symbol, 1, trigger,
+                          portfolio)
+        portfolio.next_order += 1
+        portfolio.orders[order.id] = order
+        order_book.add(order)
+    rest_time = time.perf_counter() - start
+    resting = {symbol: [] for symbol in symbols}
+    for order in order_book.orders.values():
+        resting[order.symbol].append(order)
+
+    prices = dict(start_prices)
+    walk = []
+    for _ in range(updates):
+        symbol = random.choice(symbols)
+        prices[symbol] *= random.uniform(0.995, 1.005)
+        walk.append((symbol, prices[symbol]))
+
+    start = time.perf_counter()
+    scanned = sum(len(scan(resting, symbol, price)) for symbol, price in walk)
+    scan_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    triggered = [order_book.pop_triggered(symbol, price)
+                 for symbol, price in walk]
+    book_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for (symbol, price), orders in zip(walk, triggered):
+        for order in orders:
+            order.portfolio.fill_order(order, price)
+    fill_time = time.perf_counter() - start
+    fills = sum(map(len, triggered))
+
+    print(f"orders: {count} on {symbol_count} symbols, rested in "
+          f"{rest_time * 1000:.1f} ms, quotes: {updates}")
+    print(f"scan of the open orders: {scan_time * 1e6 / updates:.1f} us "
+          f"per quote, {scanned} triggered")
+    print(f"order book: {book_time * 1e6 / updates:.1f} us per quote, "
+          f"{fills} triggered, {len(order_book)} left open")
+    print(f"fills through the portfolio: "
+          f"{fill_time * 1e6 / max(fills, 1):.1f} us per order")
@@ -0,0 +1,128 @@
+"""
+Load test for server.py: starts the session server on a temporary SQLite
+store, connects many simulated clients that create an account and loop
+through deposits, then reports the server's memory per session and the
+menu latency percentiles.
+
+Usage: python benchmarks/sessions.py [clients] [actions per client]
+"""
+import asyncio
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def resident_memory(pid):
+    """
+    Returns the resident set size of the process in bytes (Linux only).
+    """
+    with open(f"/proc/{pid}/status") as file:
+        for line in file:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+async def expect(reader, text):
+    """
+    Reads from the connection until `text` has been received.
+    """
+    received = b""
+    while text.encode() not in received:
+        chunk = await reader.read(4096)
+        if not chunk:
+            raise ConnectionError("session closed")
+        received += chunk
+    return received
+
+
+async def timed(reader, writer, send, text, latencies):
+    start = time.perf_counter()
+    writer.write(send.encode())
+    await writer.drain()
+    await expect(reader, text)
+    latencies.append(time.perf_counter() - start)
+
+
+async def client(port, actions, ready, release, latencies):
+    """
+    Creates an account, waits at the menu until every client is connected,
+    then makes `actions` deposits, timing each menu round trip.
+    """
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    await expect(reader, "two options above")
+    await timed(reader, writer, "2\r", "amount", latencies)
+    await timed(reader, writer, "1000\r", "password", latencies)
+    await timed(reader, writer, "secret\r", "continue", latencies)
+    await timed(reader, writer, "x", "Quit", latencies)
+    ready.release()
+    await release.wait()
+    for _ in range(actions):
+        await timed(reader, writer, "3\r", "increase", latencies)
+        await timed(reader, writer, "10\r", "continue", latencies)
+        await timed(reader, writer, "x", "Quit", latencies)
+    writer.close()
+
+
+async def run_load(port, pid, clients, actions):
+    latencies = []
+    ready = asyncio.Semaphore(0)
+    release = asyncio.Event()
+    idle_memory = resident_memory(pid)
+    tasks = [asyncio.ensure_future(
+        client(port, actions, ready, release, latencies))
+        for _ in range(clients)]
+    for _ in range(clients):
+        await ready.acquire()
+    loaded_memory = resident_memory(pid)
+    start = time.perf_counter()
+    release.set()
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    return idle_memory, loaded_memory, latencies, elapsed
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+if __name__ == "__main__":
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    actions = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    port = free_port()
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, STORAGE_BACKEND="sqlite",
+                   CREDS_DB=os.path.join(directory, "creds.db"))
+        server = subprocess.Popen(
+            [sys.executable, "server.py", "--port", str(port),
+             "--max-sessions", str(clients)],
+            cwd=ROOT, env=env, stdout=subprocess.PIPE)
+        try:
+            server.stdout.readline()
+            idle, loaded, latencies, elapsed = asyncio.run(
+                run_load(port, server.pid, clients, actions))
+        finally:
+            server.terminate()
+            server.wait()
+    print(f"sessions: {clients}, menu round trips: {len(latencies)}, "
+          f"elapsed: {elapsed:.2f} s")
+    print(f"server memory: {idle / 2 ** 20:.1f} MiB idle, "
+          f"{loaded / 2 ** 20:.1f} MiB with {clients} sessions, "
+          f"{(loaded - idle) / clients / 1024:.1f} KiB per session")
+    print(f"menu latency: p50 "
+          f"{statistics.median(latencies) * 1000:.2f} ms, "
+          f"p95 {percentile(latencies, 0.95) * 1000:.2f} ms, "
+          f"p99 {percentile(latencies, 0.99) * 1000:.2f} ms")
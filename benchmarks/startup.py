@@ -0,0 +1,59 @@
+"""
+Measures the time from spawning `python run.py` to the first prompt of the
+welcome menu, the way every websocket connection starts a session.
+
+Usage: python benchmarks/startup.py [runs]
+"""
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROMPT = b"Please choose one of the two options above"
+
+
+def time_to_prompt(command):
+    """
+    Starts the command and returns the seconds until PROMPT is printed.
+    """
+    env = dict(os.environ, PYTHONUNBUFFERED="1", TERM="dumb")
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=ROOT, env=env,
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL)
+    output = b""
+    while PROMPT not in output:
+        chunk = os.read(process.stdout.fileno(), 4096)
+        if not chunk:
+            raise RuntimeError("run.py exited before printing the prompt")
+        output += chunk
+    elapsed = time.perf_counter() - start
+    process.kill()
+    process.wait()
+    return elapsed
+
+
+def time_interpreter(command):
+    """
+    Returns the seconds taken by the command to start and exit.
+    """
+    start = time.perf_counter()
+    subprocess.run(command, cwd=ROOT, check=True)
+    return time.perf_counter() - start
+
+
+def summary(name, samples):
+    print(f"{name}: min {min(samples) * 1000:.1f} ms, "
+          f"median {statistics.median(samples) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    interpreter = [time_interpreter([sys.executable, "-c", "pass"])
+                   for _ in range(runs)]
+    prompt = [time_to_prompt([sys.executable, "run.py"])
+              for _ in range(runs)]
+    summary("interpreter start", interpreter)
+    summary("time to first prompt", prompt)
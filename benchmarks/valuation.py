@@ -0,0 +1,57 @@
+"""
+Compares valuing many accounts with a Python loop over their `"stock"`
+dictionaries against the columnar holdings stacked in a HoldingsBlock, on
+random accounts and one random price snapshot.
+
+Usage: python benchmarks/valuation.py [accounts] [positions per account]
+"""
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from holdings import Holdings, HoldingsBlock, price_vector  # noqa: E402
+from symbols import get_symbol_index  # noqa: E402
+
+
+def loop_values(stocks, prices):
+    values = []
+    for stock in stocks:
+        value = 0
+        for symbol, quantity in stock.items():
+            if symbol in prices:
+                value += quantity * prices[symbol]
+        values.append(value)
+    return values
+
+
+if __name__ == "__main__":
+    accounts = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    positions = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    symbols = list(get_symbol_index())
+    stocks = [{symbol: float(random.randint(1, 100))
+               for symbol in random.sample(symbols, positions)}
+              for _ in range(accounts)]
+    prices = {symbol: random.uniform(1, 500) for symbol in symbols}
+
+    start = time.perf_counter()
+    expected = loop_values(stocks, prices)
+    loop_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    block = HoldingsBlock(Holdings(stock) for stock in stocks)
+    build_time = time.perf_counter() - start
+    start = time.perf_counter()
+    values = block.value(price_vector(prices))
+    block_time = time.perf_counter() - start
+
+    error = max(abs(a - b) / max(abs(a), 1) for a, b in zip(expected, values))
+    print(f"accounts: {accounts}, positions per account: {positions}")
+    print(f"python loop: {loop_time * 1000:.1f} ms per snapshot")
+    print(f"holdings block: {block_time * 1000:.1f} ms per snapshot "
+          f"(built once in {build_time * 1000:.1f} ms)")
+    print(f"largest relative difference: {error:.2e}")
@@ -1,5 +1,6 @@
 const Pty = require('node-pty');
 const fs = require('fs');
+const net = require('net');
 
 exports.install = function () {
 
@@ -15,6 +16,11 @@ function socket() {
 
     this.on('open', function (client) {
 
+        if (process.env.SESSION_SERVER) {
+            connectSession(client);
+            return;
+        }
+
         // Spawn terminal
         client.tty = Pty.spawn('python3', ['run.py'], {
             name: 'xterm-color',
@@ -38,7 +44,7 @@ function socket() {
 
     this.on('close', function (client) {
         if (client.tty) {
-            client.tty.kill(9);
+            client.tty.kill('SIGHUP');
             client.tty = null;
             console.log("Process killed and terminal unloaded");
         }
@@ -49,6 +55,36 @@ function socket() {
     });
 }
 
+// Attach the client to the shared Python session server (server.py) given
+// as host:port in SESSION_SERVER instead of spawning a process per client.
+function connectSession(client) {
+
+    const address = process.env.SESSION_SERVER.split(':');
+    const connection = net.connect(parseInt(address[1]), address[0]);
+    connection.setEncoding('utf8');
+
+    client.tty = {
+        write: function (data) {
+            connection.write(data);
+        },
+        kill: function () {
+            connection.destroy();
+        }
+    };
+
+    connection.on('data', function (data) {
+        client.send(data);
+    });
+
+    connection.on('close', function () {
+        if (client.tty) {
+            client.tty = null;
+            client.close();
+            console.log("Session closed");
+        }
+    });
+}
+
 if (process.env.CREDS != null) {
     console.log("Creating creds.json file.");
     fs.writeFile('creds.json', process.env.CREDS, 'utf8', function (err) {
@@ -0,0 +1,293 @@
+"""
+Local store of daily OHLCV prices read through memory maps,
+- Each field (open, high, low, close, volume) is one file of float64 values
+  with one fixed-width row per trading day and one column per symbol of the
+  symbol index, missing prices are NaN,
+- `dates.i8` holds the day number of each row and is the date -> row index,
+  it is written last, so readers never see a row before all of its fields,
+- The updater only appends the days after the last stored one,
+- Readers map the files read-only, a day of prices is a zero-copy row slice
+  and every process reading the store shares the same page cache.
+
+Usage: python history.py update [PERIOD]
+       python history.py value ACCOUNT_ID YYYY-MM-DD
+"""
+import json
+import os
+import sys
+import threading
+from datetime import date, timedelta
+from holdings import np
+from symbols import get_symbol_index
+
+# Directory holding the price history files.
+HISTORY_DIR = os.getenv("HISTORY_DIR", "history")
+# History downloaded by the first update of an empty store.
+HISTORY_PERIOD = os.getenv("HISTORY_PERIOD", "1y")
+FIELDS = ("open", "high", "low", "close", "volume")
+# Maximum number of symbols sent to yfinance in one download.
+HISTORY_CHUNK_SIZE = 200
+EPOCH = date(1970, 1, 1)
+
+
+def day_number(day):
+    """
+    Returns the number of days since 1970-01-01 of a date or ISO string.
+    """
+    if isinstance(day, str):
+        day = date.fromisoformat(day)
+    return (day - EPOCH).days
+
+
+class HistoryStore:
+    def __init__(self, directory=HISTORY_DIR):
+        """
+        Opens the store in `directory`, which may be empty or missing until
+        the first update.
+        """
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.symbols = None
+        self.columns = {}
+        # symbol id -> column of the symbol, -1 when it is not stored.
+        self.index_columns = None
+        self.index_order = False
+        self.rows = 0
+        self.days = np.empty(0, dtype=np.int64)
+        self.fields = {}
+        self.refresh()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def refresh(self):
+        """
+        Maps the rows appended since the store was last mapped, so readers
+        see the updates of other processes.
+        """
+        try:
+            rows = os.path.getsize(self._path("dates.i8")) // 8
+        except OSError:
+            return
+        if self.symbols is None:
+            self._load_symbols()
+        if rows == self.rows:
+            return
+        with self.lock:
+            width = len(self.symbols)
+            self.days = np.memmap(self._path("dates.i8"), dtype=np.int64,
+                                  mode="r", shape=(rows,))
+            self.fields = {
+                field: np.memmap(self._path(f"{field}.f8"), dtype=np.float64,
+                                 mode="r", shape=(rows, width))
+                for field in FIELDS
+            }
+            self.rows = rows
+
+    def _load_symbols(self):
+        with open(self._path("symbols.json"), "r") as file:
+            self.symbols = json.load(file)
+        self.columns = {symbol: column for column, symbol
+                        in enumerate(self.symbols)}
+        self.index_columns = np.array(
+            [self.columns.get(symbol, -1) for symbol in get_symbol_index()],
+            dtype=np.int64)
+        self.index_order = tuple(self.symbols) == get_symbol_index().sorted
+
+    def dates(self):
+        """
+        Returns the stored trading days as a datetime64 array.
+        """
+        self.refresh()
+        return self.days.view("datetime64[D]")
+
+    def row_of(self, day=None):
+        """
+        Returns the row of the last trading day on or before `day` (the last
+        stored day when it is None), or None when there is none.
+        """
+        self.refresh()
+        if day is None:
+            return self.rows - 1 if self.rows else None
+        row = int(np.searchsorted(self.days, day_number(day),
+                                  side="right")) - 1
+        return row if row >= 0 else None
+
+    def prices_on(self, day=None, field="close"):
+        """
+        Returns the prices of every symbol on a day as a zero-copy row of the
+        memory map, in the column order of `self.symbols`, or None.
+        """
+        row = self.row_of(day)
+        if row is None:
+            return None
+        return self.fields[field][row]
+
+    def price(self, symbol, day=None, field="close"):
+        """
+        Returns the last known price of the symbol on or before the day,
+        or None.
+        """
+        row = self.row_of(day)
+        column = self.columns.get(symbol)
+        if row is None or column is None:
+            return None
+        values = self.fields[field][:row + 1, column]
+        known = np.flatnonzero(~np.isnan(values))
+        return float(values[known[-1]]) if len(known) else None
+
+    def history(self, symbols, start=None, end=None, field="close"):
+        """
+        Returns the trading days between `start` and `end` and a matrix with
+        one column of prices per symbol (NaN for unknown symbols).
+        """
+        self.refresh()
+        first = 0 if start is None else int(
+            np.searchsorted(self.days, day_number(start)))
+        last = self.rows if end is None else int(
+            np.searchsorted(self.days, day_number(end), side="right"))
+        columns = [self.columns.get(symbol, -1) for symbol in symbols]
+        if not self.rows:
+            return self.dates(), np.empty((0, len(columns)))
+        matrix = self.fields[field][first:last][:, columns]
+        matrix[:, np.array(columns) < 0] = np.nan
+        return self.dates()[first:last], matrix
+
+    def price_vector(self, day=None, field="close"):
+        """
+        Returns the prices of a day indexed by symbol id for the holdings
+        valuation (see holdings.py), the memory-mapped row itself when the
+        stored columns are the symbol index.
+        """
+        prices = self.prices_on(day, field)
+        if prices is None:
+            return np.full(len(get_symbol_index()), np.nan)
+        if self.index_order:
+            return prices
+        vector = prices[self.index_columns]
+        vector[self.index_columns < 0] = np.nan
+        return vector
+
+    def update(self, symbols=None, period=HISTORY_PERIOD):
+        """
+        Downloads the days after the last stored one and appends them,
+        An empty store is created with one column per symbol of the symbol
+        index and filled with `period` of history,
+        Returns the number of appended days.
+        """
+        self.refresh()
+        if self.symbols is None:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self._path("symbols.json"), "w") as file:
+                json.dump(list(get_symbol_index()), file)
+            for name in ("dates.i8",) + tuple(f"{f}.f8" for f in FIELDS):
+                open(self._path(name), "wb").close()
+            self.refresh()
+        symbols = [symbol for symbol in (symbols or self.symbols)
+                   if symbol in self.columns]
+        if self.rows:
+            last_day = EPOCH + timedelta(days=int(self.days[-1]))
+            frames = _download(symbols, start=last_day + timedelta(days=1))
+        else:
+            last_day = None
+            frames = _download(symbols, period=period)
+        days = sorted({day for frame in frames for day in frame.index.date
+                       if last_day is None or day > last_day})
+        if not days:
+            return 0
+        rows = {day: row for row, day in enumerate(days)}
+        width = len(self.symbols)
+        block = {field: np.full((len(days), width), np.nan)
+                 for field in FIELDS}
+        for frame in frames:
+            for symbol in frame.columns.get_level_values(0).unique():
+                if symbol not in self.columns:
+                    continue
+                data = frame[symbol]
+                selected = [rows.get(day) for day in data.index.date]
+                keep = [row is not None for row in selected]
+                targets = [row for row in selected if row is not None]
+                for field in FIELDS:
+                    block[field][targets, self.columns[symbol]] = (
+                        data[field.capitalize()].to_numpy()[keep])
+        self._append(block, [day_number(day) for day in days])
+        return len(days)
+
+    def _append(self, block, days):
+        """
+        Appends the new rows of every field and then their days,
+        The field files are cut back to the committed rows first, dropping
+        what an interrupted update may have left behind.
+        """
+        size = self.rows * len(self.symbols) * 8
+        for field in FIELDS:
+            with open(self._path(f"{field}.f8"), "ab") as file:
+                file.truncate(size)
+                file.write(block[field].tobytes())
+                file.flush()
+                os.fsync(file.fileno())
+        with open(self._path("dates.i8"), "ab") as file:
+            file.write(np.array(days, dtype=np.int64).tobytes())
+        self.refresh()
+
+
+def _download(symbols, **dates):
+    """
+    Downloads the daily history of the symbols from yfinance in chunks and
+    returns the data frames, grouped by ticker.
+    """
+    from providers import _yfinance
+    from quotes import _chunks
+    frames = []
+    for chunk in _chunks(symbols, HISTORY_CHUNK_SIZE):
+        data = _yfinance().download(chunk, group_by="ticker", interval="1d",
+                                    auto_adjust=True, progress=False,
+                                    threads=True, **dates)
+        if data is not None and not data.empty:
+            frames.append(data)
+    return frames
+
+
+def value_holdings(holdings, day=None, store=None):
+    """
+    Returns the market value of a Holdings object at the closing prices of
+    a stored day, positions without a price count as zero.
+    """
+    store = store or get_history_store()
+    vector = store.price_vector(day)
+    # Symbols missing from the symbol index have no stored prices.
+    stored = holdings.ids < len(vector)
+    prices = vector[holdings.ids[stored]]
+    return float(np.nansum(holdings.quantities[stored] * prices))
+
+
+_history_store = None
+
+
+def get_history_store():
+    """
+    Returns the process-wide history store, opening it on first use.
+    """
+    global _history_store
+    if _history_store is None:
+        _history_store = HistoryStore()
+    return _history_store
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "update":
+        period = sys.argv[2] if len(sys.argv) > 2 else HISTORY_PERIOD
+        added = get_history_store().update(period=period)
+        print(f"Appended {added} trading days to {HISTORY_DIR}.")
+    elif len(sys.argv) > 3 and sys.argv[1] == "value":
+        from holdings import Holdings
+        from storage import get_store
+        user = get_store().get(int(sys.argv[2]))
+        if user is None:
+            print("The account does not exist!")
+            sys.exit(1)
+        value = value_holdings(Holdings(user["stock"]), sys.argv[3])
+        print(f"Stocks of account {user['id']} on {sys.argv[3]}: {value:.2f}")
+    else:
+        print(__doc__)
+        sys.exit(1)
@@ -0,0 +1,213 @@
+"""
+Columnar stock holdings valued with NumPy,
+The positions of a portfolio are kept as parallel arrays sorted by symbol id
+(the position of the symbol in the symbol index): quantities, last prices and
+position values. Valuing a portfolio is one gather of a price vector and one
+dot product, and the positions of many portfolios can be stacked into a
+HoldingsBlock that values all of them with one array operation per price
+snapshot.
+"""
+import threading
+from bisect import bisect_left
+from collections.abc import MutableMapping
+from symbols import get_symbol_index
+
+
+class _LazyNumPy:
+    """
+    Stands in for the numpy module, which is imported on first use so that
+    sessions reach the welcome menu without loading it, the attributes are
+    kept once looked up, later lookups do not go through __getattr__.
+    """
+    def __getattr__(self, name):
+        import numpy
+        value = getattr(numpy, name)
+        setattr(self, name, value)
+        return value
+
+
+# Shared by every module working on NumPy arrays.
+np = _LazyNumPy()
+
+# Symbols of stored accounts that are missing from the symbol index get ids
+# after the last indexed symbol.
+_extra_ids = {}
+_extra_symbols = []
+_extra_lock = threading.Lock()
+
+
+def find_symbol_id(symbol):
+    """
+    Returns the id of the symbol, or None when it has none.
+    """
+    symbols = get_symbol_index().sorted
+    position = bisect_left(symbols, symbol)
+    if position < len(symbols) and symbols[position] == symbol:
+        return position
+    return _extra_ids.get(symbol)
+
+
+def symbol_id(symbol):
+    """
+    Returns the id of the symbol, giving an id to unknown symbols.
+    """
+    found = find_symbol_id(symbol)
+    if found is not None:
+        return found
+    with _extra_lock:
+        if symbol not in _extra_ids:
+            _extra_ids[symbol] = len(get_symbol_index()) + len(_extra_symbols)
+            _extra_symbols.append(symbol)
+        return _extra_ids[symbol]
+
+
+def symbol_name(symbol_id):
+    symbols = get_symbol_index().sorted
+    if symbol_id < len(symbols):
+        return symbols[symbol_id]
+    return _extra_symbols[symbol_id - len(symbols)]
+
+
+def price_vector(prices):
+    """
+    Returns a price snapshot as a float64 array indexed by symbol id, from a
+    symbol -> price dictionary, symbols without a price are NaN.
+    """
+    ids = [symbol_id(symbol) for symbol in prices]
+    vector = np.full(len(get_symbol_index()) + len(_extra_symbols), np.nan)
+    vector[ids] = list(prices.values())
+    return vector
+
+
+class Holdings(MutableMapping):
+    """
+    Maps symbol -> quantity like the dictionary it replaces, so the `stock`
+    of a Portfolio is read, updated and serialized the same way.
+    """
+    __slots__ = ("ids", "quantities", "prices", "values")
+
+    def __init__(self, positions=None):
+        positions = positions or {}
+        ids = np.fromiter((symbol_id(symbol) for symbol in positions),
+                          dtype=np.int32, count=len(positions))
+        quantities = np.fromiter(positions.values(), dtype=np.float64,
+                                 count=len(positions))
+        order = np.argsort(ids)
+        self.ids = ids[order]
+        self.quantities = quantities[order]
+        # Last price of each position (NaN until priced) and its value.
+        self.prices = np.full(len(positions), np.nan)
+        self.values = np.zeros(len(positions))
+
+    def _row(self, symbol):
+        """
+        Returns the row of the symbol in the arrays, or None.
+        """
+        found = find_symbol_id(symbol)
+        if found is None:
+            return None
+        row = int(np.searchsorted(self.ids, found))
+        if row < len(self.ids) and self.ids[row] == found:
+            return row
+        return None
+
+    def __getitem__(self, symbol):
+        row = self._row(symbol)
+        if row is None:
+            raise KeyError(symbol)
+        return float(self.quantities[row])
+
+    def __setitem__(self, symbol, quantity):
+        row = self._row(symbol)
+        if row is not None:
+            self.quantities[row] = quantity
+            return
+        new_id = symbol_id(symbol)
+        row = int(np.searchsorted(self.ids, new_id))
+        self.ids = np.insert(self.ids, row, new_id)
+        self.quantities = np.insert(self.quantities, row, quantity)
+        self.prices = np.insert(self.prices, row, np.nan)
+        self.values = np.insert(self.values, row, 0)
+
+    def __delitem__(self, symbol):
+        row = self._row(symbol)
+        if row is None:
+            raise KeyError(symbol)
+        self.ids = np.delete(self.ids, row)
+        self.quantities = np.delete(self.quantities, row)
+        self.prices = np.delete(self.prices, row)
+        self.values = np.delete(self.values, row)
+
+    def __contains__(self, symbol):
+        return self._row(symbol) is not None
+
+    def __iter__(self):
+        return map(symbol_name, self.ids.tolist())
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def to_dict(self):
+        """
+        Returns the positions in the `"stock"` layout of stored accounts.
+        """
+        return dict(zip(self, self.quantities.tolist()))
+
+    def set_price(self, symbol, price):
+        """
+        Prices one position and returns the change of its value.
+        """
+        row = self._row(symbol)
+        value = self.quantities[row] * price
+        change = value - self.values[row]
+        self.prices[row] = price
+        self.values[row] = value
+        return float(change)
+
+    def revalue(self, vector):
+        """
+        Prices every position from a price vector (see `price_vector`) and
+        returns the market value, positions without a price count as zero.
+        """
+        self.prices = vector[self.ids]
+        self.values = np.where(np.isnan(self.prices), 0,
+                               self.quantities * self.prices)
+        return float(self.values.sum())
+
+    def all_priced(self):
+        return not np.isnan(self.prices).any()
+
+    def missing_prices(self):
+        """
+        Returns the set of symbols whose positions have no price.
+        """
+        return {symbol for symbol, missing
+                in zip(self, np.isnan(self.prices).tolist()) if missing}
+
+
+class HoldingsBlock:
+    """
+    The positions of many portfolios concatenated into single arrays, with
+    the owner of each position, so all of them are valued together.
+    """
+    def __init__(self, holdings):
+        holdings = list(holdings)
+        self.count = len(holdings)
+        self.owners = np.repeat(np.arange(self.count),
+                                [len(each) for each in holdings])
+        self.ids = np.concatenate(
+            [np.empty(0, dtype=np.int32)] + [each.ids for each in holdings])
+        self.quantities = np.concatenate(
+            [np.empty(0)] + [each.quantities for each in holdings])
+
+    def value(self, vector):
+        """
+        Returns the market value of every portfolio at the prices of the
+        vector, in the order the holdings were given.
+        """
+        prices = np.nan_to_num(vector[self.ids])
+        return np.bincount(self.owners, weights=self.quantities * prices,
+                           minlength=self.count)
@@ -0,0 +1,137 @@
+"""
+Incremental reading and writing of large JSON arrays such as the account
+list, one element at a time,
+- iter_array parses the elements of a top-level array from a stream of
+  text or byte chunks, keeping only the unparsed rest of the stream in
+  memory, so the memory needed is bounded by the largest element rather
+  than by the size of the array,
+- write_array writes elements to a file as one JSON array as they come.
+"""
+import codecs
+import json
+import re
+
+# Number of bytes read from a file or a response at a time.
+CHUNK_SIZE = 1 << 16
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# Characters that may still continue a number decoded from the buffer.
+_NUMBER_TAIL = re.compile(r"[0-9.eE+-]*")
+
+
+class _Chunks:
+    def __init__(self, chunks):
+        """
+        Text buffer over an iterator of text or UTF-8 byte chunks.
+        """
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.text = ""
+        self.position = 0
+        self.done = False
+
+    def more(self):
+        """
+        Appends the next chunk to the buffer, dropping the consumed text,
+        returns False at the end of the stream.
+        """
+        if self.done:
+            return False
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.done = True
+            chunk = self.decoder.decode(b"", final=True)
+        elif isinstance(chunk, bytes):
+            chunk = self.decoder.decode(chunk)
+        self.text = self.text[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def skip_whitespace(self):
+        """
+        Returns the next significant character without consuming it, or
+        None at the end of the stream.
+        """
+        while True:
+            self.position = _WHITESPACE.match(self.text, self.position).end()
+            if self.position < len(self.text):
+                return self.text[self.position]
+            if not self.more():
+                return None
+
+    def expect(self, characters):
+        character = self.skip_whitespace()
+        if character is None or character not in characters:
+            raise ValueError(f"Expected one of {characters!r} at "
+                             f"{character!r} in the JSON stream")
+        self.position += 1
+        return character
+
+    def value(self):
+        """
+        Decodes the next JSON value, reading chunks until it is complete.
+        """
+        self.skip_whitespace()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.position)
+            except ValueError:
+                if not self.more():
+                    raise
+                continue
+            # A number may go on in the next chunk, even after a decimal
+            # point or an exponent marker, which end the decoded prefix.
+            if (isinstance(value, (int, float)) and not self.done and
+                    _NUMBER_TAIL.match(self.text, end).end() ==
+                    len(self.text)):
+                self.more()
+                continue
+            self.position = end
+            return value
+
+
+def iter_array(chunks):
+    """
+    Yields the elements of the JSON array spread over `chunks`, an iterable
+    of text or byte chunks, parsing the array as it is read,
+    Chunks may split a value anywhere, numbers included:
+
+    >>> list(iter_array(["[1.", "5, 1e", "3, 2", "E-1, tr", "ue]"]))
+    [1.5, 1000.0, 0.2, True]
+    """
+    stream = _Chunks(chunks)
+    stream.expect("[")
+    if stream.skip_whitespace() == "]":
+        return
+    while True:
+        yield stream.value()
+        if stream.expect(",]") == "]":
+            return
+
+
+def read_chunks(file, size=CHUNK_SIZE):
+    """
+    Yields the content of an open file `size` characters or bytes at a
+    time.
+    """
+    while True:
+        chunk = file.read(size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def write_array(items, file):
+    """
+    Writes the items to the open text file as one JSON array, one element
+    per line, returns the number of items written.
+    """
+    count = 0
+    file.write("[")
+    for item in items:
+        file.write(",\n" if count else "\n")
+        file.write(json.dumps(item))
+        count += 1
+    file.write("\n]\n" if count else "]\n")
+    return count
@@ -0,0 +1,391 @@
+"""
+Append-only ledger of the operations made on each account,
+Every deposit, withdrawal, buy and sell, and every limit or stop order
+placed or cancelled, is appended as one JSON line, as is a "rejected"
+event for an operation a merge of two sessions dropped, the account record in
+the storage backend acts as the snapshot and remembers the sequence number
+of the last event it includes (`ledger_seq`). Loading an account replays
+the events logged after its snapshot, and a background compaction pass
+writes new snapshots and starts new log segments.
+
+Usage: python ledger.py report ACCOUNT_ID
+       python ledger.py compact
+"""
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from storage import get_store
+try:
+    import fcntl
+except ImportError:
+    # Without fcntl (Windows) appends are only serialized within a process.
+    fcntl = None
+
+# Directory holding the ledger, the ledger is disabled when it is not set.
+LEDGER_DIR = os.getenv("LEDGER_DIR")
+# Whether each appended event is forced to disk before returning.
+LEDGER_FSYNC = os.getenv("LEDGER_FSYNC", "1") == "1"
+# Number of seconds between two background compaction passes.
+LEDGER_COMPACT_INTERVAL = float(os.getenv("LEDGER_COMPACT_INTERVAL", "60"))
+# Number of events after which compaction starts a new log segment.
+LEDGER_SEGMENT_EVENTS = int(os.getenv("LEDGER_SEGMENT_EVENTS", "100"))
+
+
+def next_order(record):
+    """
+    Returns the number of the next order of the account record, records
+    written before the counter was stored continue after their open orders.
+    """
+    if "next_order" in record:
+        return record["next_order"]
+    return max((order["id"] for order in record.get("orders", ())),
+               default=0) + 1
+
+
+def apply_event(record, event, renumbered=None):
+    """
+    Applies one ledger event to an account record in place and returns it,
+    An event the record already includes (its `seq` is not above the
+    record's `ledger_seq`) is skipped,
+    An order whose number was taken meanwhile by another session gets the
+    next free one, `renumbered` (old number -> new number) is shared by the
+    events applied together so that their fills and cancels follow it.
+    """
+    if already_applied(record, event):
+        return record
+    if renumbered is None:
+        renumbered = {}
+    kind = event["type"]
+    if kind == "deposit":
+        record["investment"] += event["amount"]
+        record["buying_power"] += event["amount"]
+    elif kind == "withdraw":
+        record["investment"] -= event["amount"]
+        record["buying_power"] -= event["amount"]
+    elif kind == "buy":
+        symbol = event["symbol"]
+        record["stock"][symbol] = (record["stock"].get(symbol, 0) +
+                                   event["quantity"])
+        record["buying_power"] -= event["quantity"] * event["price"]
+    elif kind == "sell":
+        symbol = event["symbol"]
+        record["stock"][symbol] = (record["stock"].get(symbol, 0) -
+                                   event["quantity"])
+        record["buying_power"] += event["quantity"] * event["price"]
+    elif kind == "order":
+        number = event["id"]
+        if number < next_order(record):
+            renumbered[number] = next_order(record)
+            number = renumbered[number]
+        record["next_order"] = number + 1
+        record.setdefault("orders", []).append({
+            "id": number, "side": event["side"], "kind": event["kind"],
+            "symbol": event["symbol"], "quantity": event["quantity"],
+            "trigger": event["trigger"]})
+    if kind in ("buy", "sell", "cancel") and "order" in event:
+        # The order was filled, rejected or cancelled.
+        number = renumbered.get(event["order"], event["order"])
+        record["orders"] = [order for order in record.get("orders", ())
+                            if order["id"] != number]
+    if "seq" in event:
+        record["ledger_seq"] = event["seq"]
+    return record
+
+
+def already_applied(record, event):
+    """
+    Tells whether the record's snapshot already includes the ledger event.
+    """
+    return "seq" in event and event["seq"] <= record.get("ledger_seq", 0)
+
+
+def check_event(record, event, renumbered=None):
+    """
+    Returns why the event cannot be applied to the account record as it is
+    now (not enough buying power or shares, or the order it fills is not
+    open anymore), or None when it can,
+    `renumbered` maps the order numbers changed by apply_event.
+    """
+    kind = event["type"]
+    if kind in ("buy", "sell") and "order" in event:
+        number = (renumbered or {}).get(event["order"], event["order"])
+        if all(order["id"] != number for order in record.get("orders", ())):
+            return f"the order #{number} was already filled or cancelled"
+    if kind == "withdraw" and record["buying_power"] < event["amount"]:
+        return "there is not enough liquidity"
+    if kind == "buy" and (record["buying_power"] <
+                          event["quantity"] * event["price"]):
+        return "there is not enough buying power"
+    if kind == "sell" and (record["stock"].get(event["symbol"], 0) <
+                           event["quantity"]):
+        return f"there are not enough '{event['symbol']}' stocks"
+    return None
+
+
+def apply_checked(record, event, renumbered=None):
+    """
+    Applies the event if check_event lets it, otherwise only closes the
+    order it filled and moves `ledger_seq` past it,
+    Returns why the event was dropped, or None.
+    """
+    reason = check_event(record, event, renumbered)
+    if reason is None:
+        apply_event(record, event, renumbered)
+    else:
+        dropped = {key: event[key] for key in ("order", "seq") if key in event}
+        apply_event(record, dict(dropped, type="cancel"), renumbered)
+    return reason
+
+
+class Ledger:
+    """
+    Keeps one directory per account with numbered log segments, each
+    segment file is named after the sequence number of its first event.
+    """
+    def __init__(self, directory=LEDGER_DIR, fsync=LEDGER_FSYNC):
+        self.directory = directory
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        # account id -> [last sequence number, active segment path,
+        # number of events in the active segment, its size in bytes]
+        self.heads = {}
+        self.thread = None
+
+    def _account_dir(self, account_id):
+        return os.path.join(self.directory, str(account_id))
+
+    def _segments(self, account_id):
+        """
+        Returns the (first sequence number, path) of every segment of the
+        account in order.
+        """
+        directory = self._account_dir(account_id)
+        if not os.path.isdir(directory):
+            return []
+        segments = [(int(name[:-4]), os.path.join(directory, name))
+                    for name in os.listdir(directory)
+                    if name.endswith(".log")]
+        return sorted(segments)
+
+    @contextlib.contextmanager
+    def _locked(self, account_id):
+        """
+        Holds the lock file of the account's directory exclusively, against
+        the other threads and, with flock, against the other processes
+        writing to the same ledger.
+        """
+        directory = self._account_dir(account_id)
+        os.makedirs(directory, exist_ok=True)
+        with self.lock, open(os.path.join(directory, "lock"), "a") as file:
+            if fcntl is not None:
+                fcntl.flock(file, fcntl.LOCK_EX)
+            yield
+
+    def _head(self, account_id):
+        """
+        Returns the head of the account as found on disk, the caller holds
+        the account's lock,
+        The cached head is reused while the last segment is the same file
+        with the same size, otherwise the segment is read again since
+        another process appended to it or started a new one.
+        """
+        segments = self._segments(account_id)
+        if not segments:
+            head = [0, self._segment_path(account_id, 1), 0, 0]
+            self.heads[account_id] = head
+            return head
+        first_seq, path = segments[-1]
+        size = os.path.getsize(path)
+        head = self.heads.get(account_id)
+        if head is None or head[1] != path or head[3] != size:
+            count = 0
+            with open(path, "r") as file:
+                for count, _ in enumerate(file, 1):
+                    pass
+            head = [first_seq + count - 1, path, count, size]
+            self.heads[account_id] = head
+        return head
+
+    def _segment_path(self, account_id, first_seq):
+        return os.path.join(self._account_dir(account_id),
+                            f"{first_seq:012d}.log")
+
+    def append(self, account_id, event):
+        """
+        Appends the event to the account's active segment, stamping it with
+        the next sequence number and the current time, under the account's
+        lock so that processes sharing the ledger never hand out the same
+        sequence number,
+        Returns the sequence number.
+        """
+        with self._locked(account_id):
+            head = self._head(account_id)
+            event = dict(event, seq=head[0] + 1,
+                         time=datetime.now(timezone.utc).isoformat())
+            with open(head[1], "a") as file:
+                file.write(json.dumps(event) + "\n")
+                file.flush()
+                if self.fsync:
+                    os.fsync(file.fileno())
+                head[3] = file.tell()
+            head[0] += 1
+            head[2] += 1
+            seq = head[0]
+        self._start_compaction()
+        return seq
+
+    def events(self, account_id, after_seq=0):
+        """
+        Yields the events of the account with a sequence number above
+        `after_seq`, skipping the segments that end before it.
+        """
+        segments = self._segments(account_id)
+        for position, (first_seq, path) in enumerate(segments):
+            following = segments[position + 1:position + 2]
+            if following and following[0][0] <= after_seq + 1:
+                continue
+            with open(path, "r") as file:
+                for line in file:
+                    event = json.loads(line)
+                    if event["seq"] > after_seq:
+                        yield event
+
+    def replay(self, record):
+        """
+        Returns a copy of the account record brought up to date with the
+        events logged after its snapshot, the events that no longer pass
+        check_event (sessions sharing the account) are skipped.
+        """
+        record = dict(record, stock=dict(record["stock"]))
+        renumbered = {}
+        for event in self.events(record["id"], record.get("ledger_seq", 0)):
+            apply_checked(record, event, renumbered)
+        return record
+
+    def compact(self):
+        """
+        Writes a new snapshot of every account with events missing from its
+        stored record, and starts a new segment for the accounts whose
+        active segment has grown past LEDGER_SEGMENT_EVENTS events.
+        """
+        if not os.path.isdir(self.directory):
+            return
+        store = get_store()
+        for name in os.listdir(self.directory):
+            if not name.isdigit():
+                continue
+            account_id = int(name)
+            record = store.get(account_id)
+            if record is None:
+                continue
+            seq = record.get("ledger_seq", 0)
+            record = self.replay(record)
+            if record.get("ledger_seq", 0) > seq:
+                # A session that wrote the account since it was read has a
+                # newer snapshot, the next compaction catches up with it.
+                if account_id in store.compare_and_swap_many([record])[1]:
+                    continue
+            with self._locked(account_id):
+                head = self._head(account_id)
+                if (head[2] >= LEDGER_SEGMENT_EVENTS and
+                        record.get("ledger_seq", 0) == head[0]):
+                    head[1] = self._segment_path(account_id, head[0] + 1)
+                    head[2] = 0
+                    head[3] = 0
+                    open(head[1], "a").close()
+
+    def _start_compaction(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(LEDGER_COMPACT_INTERVAL)
+            try:
+                self.compact()
+            except Exception:
+                # The next pass retries, the ledger still holds every event.
+                pass
+
+
+def position_report(events):
+    """
+    Computes cost basis and profit and loss from a sequence of events with
+    the average cost method, no quotes are needed,
+    The operations a merge dropped (marked by a later "rejected" event) are
+    left out, as are the sales of more shares than the position holds,
+    Returns the cash flows and a dictionary symbol -> position with the
+    quantity held, the average cost and the realized profit or loss.
+    """
+    events = list(events)
+    rejected = {event["event_seq"] for event in events
+                if event["type"] == "rejected"}
+    deposits = 0
+    withdrawals = 0
+    positions = {}
+    for event in events:
+        kind = event["type"]
+        if event.get("seq") in rejected:
+            continue
+        if kind == "deposit":
+            deposits += event["amount"]
+        elif kind == "withdraw":
+            withdrawals += event["amount"]
+        elif kind in ("buy", "sell"):
+            position = positions.setdefault(
+                event["symbol"], {"quantity": 0, "cost": 0, "realized": 0})
+            if kind == "buy":
+                position["quantity"] += event["quantity"]
+                position["cost"] += event["quantity"] * event["price"]
+            elif position["quantity"] >= event["quantity"] > 0:
+                average = position["cost"] / position["quantity"]
+                position["realized"] += (event["price"] -
+                                         average) * event["quantity"]
+                position["cost"] -= average * event["quantity"]
+                position["quantity"] -= event["quantity"]
+    for position in positions.values():
+        position["average_cost"] = (position["cost"] / position["quantity"]
+                                    if position["quantity"] else 0)
+    return {"deposits": deposits, "withdrawals": withdrawals,
+            "positions": positions}
+
+
+_ledger = None
+
+
+def get_ledger():
+    """
+    Returns the process-wide ledger, or None when LEDGER_DIR is not set.
+    """
+    global _ledger
+    if _ledger is None and LEDGER_DIR:
+        _ledger = Ledger()
+    return _ledger
+
+
+if __name__ == "__main__":
+    ledger = get_ledger()
+    if ledger is None or len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    if sys.argv[1] == "compact":
+        ledger.compact()
+    elif sys.argv[1] == "report" and len(sys.argv) > 2:
+        report = position_report(ledger.events(int(sys.argv[2])))
+        print(f"Deposits: {report['deposits']}, "
+              f"withdrawals: {report['withdrawals']}")
+        for symbol, position in sorted(report["positions"].items()):
+            print(f"{symbol}: quantity {position['quantity']}, "
+                  f"average cost {position['average_cost']:.2f}, "
+                  f"realized P&L {position['realized']:.2f}")
+        realized = sum(position["realized"]
+                       for position in report["positions"].values())
+        print(f"Total realized P&L: {realized:.2f}")
+    else:
+        print(__doc__)
+        sys.exit(1)
@@ -0,0 +1,199 @@
+"""
+Timing spans and counters of the hot paths,
+- Enabled with METRICS=1, otherwise `timed` returns the function unchanged
+  and `span` returns a shared do-nothing context, so disabled metrics cost
+  nothing on decorated functions and one call on inline spans,
+- Every measurement goes to the registry of the process and to the one of
+  the current session (the session of the thread, see server.py),
+- On quit the session summary is written as JSON and the process totals as
+  a Prometheus text dump to METRICS_DIR, the dump is also written at exit.
+"""
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+
+# Whether spans and counters are recorded.
+METRICS = os.getenv("METRICS", "0") == "1"
+# Directory the session summaries and the Prometheus dump are written to.
+METRICS_DIR = os.getenv("METRICS_DIR", "metrics")
+PREFIX = "portfolio"
+
+
+class Registry:
+    def __init__(self):
+        """
+        Aggregates spans as name -> [count, total seconds, max seconds] and
+        counters as name -> total.
+        """
+        self.spans = {}
+        self.counters = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def observe(self, name, seconds):
+        with self.lock:
+            span = self.spans.get(name)
+            if span is None:
+                self.spans[name] = [1, seconds, seconds]
+            else:
+                span[0] += 1
+                span[1] += seconds
+                if seconds > span[2]:
+                    span[2] = seconds
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def summary(self):
+        """
+        Returns the spans and counters as a JSON-serializable dictionary.
+        """
+        with self.lock:
+            return {
+                "started": self.started,
+                "ended": time.time(),
+                "spans": {
+                    name: {"count": count, "seconds": total,
+                           "mean_seconds": total / count,
+                           "max_seconds": largest}
+                    for name, (count, total, largest) in self.spans.items()
+                },
+                "counters": dict(self.counters)
+            }
+
+    def prometheus(self):
+        """
+        Returns the spans and counters in the Prometheus text format.
+        """
+        with self.lock:
+            spans = sorted(self.spans.items())
+            counters = sorted(self.counters.items())
+        lines = [f"# TYPE {PREFIX}_span_seconds summary"]
+        for name, (count, total, largest) in spans:
+            lines.append(f'{PREFIX}_span_seconds_count{{span="{name}"}} '
+                         f'{count}')
+            lines.append(f'{PREFIX}_span_seconds_sum{{span="{name}"}} '
+                         f'{total:.6f}')
+        lines.append(f"# TYPE {PREFIX}_span_max_seconds gauge")
+        for name, (count, total, largest) in spans:
+            lines.append(f'{PREFIX}_span_max_seconds{{span="{name}"}} '
+                         f'{largest:.6f}')
+        lines.append(f"# TYPE {PREFIX}_events_total counter")
+        for name, total in counters:
+            lines.append(f'{PREFIX}_events_total{{event="{name}"}} {total}')
+        return "\n".join(lines) + "\n"
+
+
+process = Registry()
+_local = threading.local()
+
+
+def session():
+    """
+    Returns the registry of the session running in the current thread.
+    """
+    registry = getattr(_local, "registry", None)
+    if registry is None:
+        registry = _local.registry = Registry()
+    return registry
+
+
+def record(name, seconds):
+    process.observe(name, seconds)
+    session().observe(name, seconds)
+
+
+def increment(name, amount=1):
+    if METRICS:
+        process.increment(name, amount)
+        session().increment(name, amount)
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+
+_no_span = _NoSpan()
+
+
+def span(name):
+    """
+    Returns a context manager timing its block under `name`.
+    """
+    return _Span(name) if METRICS else _no_span
+
+
+def timed(name):
+    """
+    Decorator timing every call of the function under `name`, the function
+    is returned unchanged when metrics are disabled.
+    """
+    def decorate(function):
+        if not METRICS:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*arguments, **keywords):
+            start = time.perf_counter()
+            try:
+                return function(*arguments, **keywords)
+            finally:
+                record(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+def write_process_dump():
+    """
+    Writes the process totals to METRICS_DIR/metrics-PID.prom.
+    """
+    if not METRICS:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"metrics-{os.getpid()}.prom")
+    with open(path, "w") as file:
+        file.write(process.prometheus())
+
+
+def end_session():
+    """
+    Writes the summary of the current session as JSON and the process dump,
+    then starts a new session for the thread.
+    """
+    if not METRICS:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    summary = dict(session().summary(), pid=os.getpid())
+    path = os.path.join(METRICS_DIR, f"session-{os.getpid()}-"
+                                     f"{threading.get_ident()}-"
+                                     f"{time.time_ns()}.json")
+    with open(path, "w") as file:
+        json.dump(summary, file, indent=2)
+    write_process_dump()
+    _local.registry = Registry()
+
+
+atexit.register(write_process_dump)
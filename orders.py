@@ -0,0 +1,200 @@
+"""
+Resting limit and stop orders,
+- A buy limit fills once the price is at or below its limit, a sell limit
+  once it is at or above it, a buy stop once the price rises to its stop
+  and a sell stop once the price falls to it,
+- The book keeps two heaps of open orders per symbol keyed by trigger
+  price: the orders triggered by a rising price (sell limits, buy stops)
+  lowest trigger first, and those triggered by a falling price (buy limits,
+  sell stops) highest trigger first,
+- Every price stored in the quote cache is matched against the book of its
+  symbol and only the orders whose trigger was crossed are popped, so a
+  quote costs one comparison per heap plus O(log n) per triggered order,
+  whatever the number of open orders,
+- Triggered orders are filled at that price through Portfolio.buy_stock and
+  sell_stock, the open orders are stored with the account record.
+"""
+import heapq
+import itertools
+import threading
+from metrics import increment, timed
+from quotes import quote_cache
+from symbols import get_symbol_index
+
+SIDES = ("buy", "sell")
+KINDS = ("limit", "stop")
+# Books with more cancelled than open entries are rebuilt.
+REBUILD_RATIO = 1
+
+
+class Order:
+    __slots__ = ("id", "side", "kind", "symbol", "quantity", "trigger",
+                 "portfolio", "status", "message")
+
+    def __init__(self, number, side, kind, symbol, quantity, trigger,
+                 portfolio=None):
+        """
+        An order of `portfolio` to buy or sell `quantity` shares of
+        `symbol` once its price crosses `trigger`, `status` goes from
+        "open" to "filled", "rejected" or "cancelled",
+        The strings are shared ones, not the copies decoded from the record.
+        """
+        self.id = number
+        self.side = SIDES[SIDES.index(side)]
+        self.kind = KINDS[KINDS.index(kind)]
+        self.symbol = get_symbol_index().intern(symbol)
+        self.quantity = quantity
+        self.trigger = trigger
+        self.portfolio = portfolio
+        self.status = "open"
+        self.message = None
+
+    @classmethod
+    def from_record(cls, record, portfolio=None):
+        return cls(record["id"], record["side"], record["kind"],
+                   record["symbol"], record["quantity"], record["trigger"],
+                   portfolio)
+
+    def to_record(self):
+        return {
+            "id": self.id,
+            "side": self.side,
+            "kind": self.kind,
+            "symbol": self.symbol,
+            "quantity": self.quantity,
+            "trigger": self.trigger
+        }
+
+    def rises(self):
+        """
+        Tells whether a rising price triggers the order.
+        """
+        return (self.side == "sell") == (self.kind == "limit")
+
+    def triggered_by(self, price):
+        if self.rises():
+            return price >= self.trigger
+        return price <= self.trigger
+
+    def __str__(self):
+        return (f"#{self.id} {self.side} {self.kind} {self.quantity} "
+                f"{self.symbol} at {self.trigger}")
+
+
+class OrderBook:
+    def __init__(self):
+        """
+        Empty book,
+        - `books` maps a symbol to its [rising, falling] heaps of
+          (key, sequence, order) entries, the key being the trigger for
+          rising orders and minus the trigger for falling ones,
+        - `orders` maps (account id, order id) to the open order, an order
+          loaded again by a new session replaces the previous copy,
+        - Cancelled and replaced orders stay in the heaps until they are
+          popped or the heaps are rebuilt.
+        """
+        self.books = {}
+        self.orders = {}
+        self.dead = {}
+        self.sequence = itertools.count()
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.orders)
+
+    def symbols(self):
+        """
+        Returns the symbols with open orders.
+        """
+        with self.lock:
+            return [symbol for symbol, (rising, falling) in self.books.items()
+                    if len(rising) + len(falling) > self.dead.get(symbol, 0)]
+
+    def add(self, order):
+        """
+        Rests an open order in the book and watches its symbol.
+        """
+        key = (order.portfolio.id, order.id)
+        with self.lock:
+            previous = self.orders.get(key)
+            if previous is not None:
+                previous.status = "replaced"
+                self._forget(previous.symbol)
+            self.orders[key] = order
+            book = self.books.get(order.symbol)
+            if book is None:
+                book = self.books[order.symbol] = [[], []]
+                quote_cache.watch(order.symbol, self)
+            if order.rises():
+                heapq.heappush(book[0], (order.trigger,
+                                         next(self.sequence), order))
+            else:
+                heapq.heappush(book[1], (-order.trigger,
+                                         next(self.sequence), order))
+
+    def cancel(self, order):
+        """
+        Takes an open order out of the book, returns whether it was open.
+        """
+        with self.lock:
+            if order.status != "open":
+                return False
+            order.status = "cancelled"
+            self.orders.pop((order.portfolio.id, order.id), None)
+            self._forget(order.symbol)
+            return True
+
+    def _forget(self, symbol):
+        """
+        Counts a dead entry of the symbol's heaps and rebuilds them once
+        they hold more dead entries than REBUILD_RATIO times the open ones.
+        """
+        dead = self.dead[symbol] = self.dead.get(symbol, 0) + 1
+        book = self.books[symbol]
+        if dead > REBUILD_RATIO * (len(book[0]) + len(book[1]) - dead):
+            for heap in book:
+                heap[:] = [entry for entry in heap
+                           if entry[2].status == "open"]
+                heapq.heapify(heap)
+            self.dead[symbol] = 0
+
+    def pop_triggered(self, symbol, price):
+        """
+        Removes and returns the open orders of the symbol triggered by
+        `price`, in the order they were rested.
+        """
+        with self.lock:
+            book = self.books.get(symbol)
+            if book is None:
+                return []
+            rising, falling = book
+            triggered = []
+            popped = 0
+            while rising and rising[0][0] <= price:
+                triggered.append(heapq.heappop(rising))
+            while falling and -falling[0][0] >= price:
+                triggered.append(heapq.heappop(falling))
+            orders = []
+            for key, sequence, order in sorted(triggered,
+                                               key=lambda entry: entry[1]):
+                if order.status != "open":
+                    popped += 1
+                    continue
+                del self.orders[(order.portfolio.id, order.id)]
+                orders.append(order)
+            if popped:
+                self.dead[symbol] -= popped
+            return orders
+
+    @timed("orders.match")
+    def on_quote(self, symbol, price):
+        """
+        Called by the quote cache with every new price, fills the orders it
+        triggers.
+        """
+        for order in self.pop_triggered(symbol, price):
+            order.portfolio.fill_order(order, price)
+            increment(f"orders.{order.status}")
+
+
+order_book = OrderBook()
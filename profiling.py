@@ -0,0 +1,130 @@
+"""
+Profiling of the menu actions (python run.py --profile [DIR]),
+Each action (login, create, buy, sell, increase, withdraw, order, status)
+runs in its own profiler scope, repeated actions add up in the same scope.
+At exit every action's deterministic profile is written to
+DIR/ACTION.pstats, and the stacks sampled while the actions ran are written
+to DIR/stacks.folded, one `action;outer;...;inner count` line per stack,
+the collapsed format read by flamegraph.pl and speedscope.
+"""
+import atexit
+import cProfile
+import os
+import sys
+import threading
+import time
+
+# Directory the profiles are written to.
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+# Number of seconds between two stack samples.
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.001"))
+
+
+class _NoScope:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+
+_no_scope = _NoScope()
+
+
+class ActionProfiler:
+    def __init__(self):
+        """
+        Disabled until `enable` is called, scopes then cost nothing.
+        """
+        self.directory = None
+        self.profiles = {}
+        self.stacks = {}
+        self.active = None
+        self.thread_id = None
+        self.lock = threading.Lock()
+        self.sampler = None
+
+    def enable(self, directory=PROFILE_DIR):
+        self.directory = directory
+        atexit.register(self.write)
+
+    def scope(self, action):
+        """
+        Returns a context manager profiling its block as `action`, scopes
+        opened inside another scope are part of the outer one.
+        """
+        if self.directory is None or self.active is not None:
+            return _no_scope
+        return _Scope(self, action)
+
+    def _start(self, action):
+        profile = self.profiles.get(action)
+        if profile is None:
+            profile = self.profiles[action] = cProfile.Profile()
+        self.thread_id = threading.get_ident()
+        self.active = action
+        if self.sampler is None:
+            self.sampler = threading.Thread(target=self._sample, daemon=True)
+            self.sampler.start()
+        profile.enable()
+
+    def _stop(self):
+        self.profiles[self.active].disable()
+        self.active = None
+
+    def _sample(self):
+        """
+        Records the stack of the profiled thread every PROFILE_INTERVAL
+        seconds while a scope is open.
+        """
+        while True:
+            time.sleep(PROFILE_INTERVAL)
+            action = self.active
+            if action is None:
+                continue
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} "
+                             f"({os.path.basename(code.co_filename)}:"
+                             f"{code.co_firstlineno})")
+                frame = frame.f_back
+            stack = ";".join([action] + names[::-1])
+            with self.lock:
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def write(self):
+        """
+        Writes the pstats file of every action and the collapsed stacks.
+        """
+        if self.directory is None or not self.profiles:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        for action, profile in self.profiles.items():
+            profile.dump_stats(os.path.join(self.directory,
+                                            f"{action}.pstats"))
+        with self.lock:
+            stacks = sorted(self.stacks.items())
+        with open(os.path.join(self.directory, "stacks.folded"), "w") as file:
+            for stack, count in stacks:
+                file.write(f"{stack} {count}\n")
+
+
+class _Scope:
+    __slots__ = ("profiler", "action")
+
+    def __init__(self, profiler, action):
+        self.profiler = profiler
+        self.action = action
+
+    def __enter__(self):
+        self.profiler._start(self.action)
+        return self
+
+    def __exit__(self, *exception):
+        self.profiler._stop()
+        return False
+
+
+profiler = ActionProfiler()
@@ -0,0 +1,260 @@
+"""
+Quote providers: where get_stock_price and the bulk valuation get prices,
+- YFinanceProvider fetches live prices from Yahoo Finance,
+- HistoryProvider reads the last closes of the local price history,
+- RecordingProvider wraps another provider and appends every call, its
+  prices, latency and error to a JSON lines file,
+- ReplayProvider serves such a recording with its recorded latencies or a
+  fixed one, and with injected errors, so runs are reproducible offline.
+
+Every provider has `fetch(symbol)`, which returns a price or raises, and
+`fetch_many(symbols)`, which returns a dictionary symbol -> price that
+leaves out the symbols it has no price for.
+"""
+import json
+import os
+import random
+import threading
+import time
+from metrics import timed
+
+# yfinance pulls in pandas and NumPy, it is imported on the first quote so
+# that sessions reach the welcome menu without paying for it.
+yf = None
+
+# Where quotes come from: "live" (yfinance), "history" (the last closing
+# prices of the local price history, see history.py) or "replay" (a
+# recording made with QUOTE_RECORD).
+QUOTE_SOURCE = os.getenv("QUOTE_SOURCE", "live")
+# File every quote call is recorded to, nothing is recorded when unset.
+QUOTE_RECORD = os.getenv("QUOTE_RECORD")
+# Recording served by the replay provider.
+QUOTE_REPLAY_FILE = os.getenv("QUOTE_REPLAY_FILE", "quotes.jsonl")
+# Fixed latency of replayed calls in seconds, the recorded latencies are
+# replayed when unset.
+QUOTE_REPLAY_LATENCY = os.getenv("QUOTE_REPLAY_LATENCY")
+# Share of replayed calls that fail, and the seed making them reproducible.
+QUOTE_REPLAY_ERROR_RATE = float(os.getenv("QUOTE_REPLAY_ERROR_RATE", "0"))
+QUOTE_REPLAY_SEED = int(os.getenv("QUOTE_REPLAY_SEED", "0"))
+
+
+class QuoteError(Exception):
+    """
+    Raised when no price, not even a stale one, is known for a symbol.
+    """
+
+
+def _yfinance():
+    """
+    Returns the yfinance module, importing it on first use.
+    """
+    global yf
+    if yf is None:
+        import yfinance
+        yf = yfinance
+    return yf
+
+
+class YFinanceProvider:
+    @timed("yfinance.history")
+    def fetch(self, symbol):
+        """
+        Retrieve the latest closing stock price for a given symbol,
+        - Create a Ticker object for the given stock symbol using yfinance,
+        - Retrieve the historical price data for the stock for a 1-day
+          period,
+        - Access the closing price for the most recent day available,
+        - The closing stock price as a float or numeric value.
+        """
+        stock = _yfinance().Ticker(symbol)
+        stock_price = stock.history(period="1d")['Close'].iloc[0]
+        return float(stock_price)
+
+    @timed("yfinance.download")
+    def fetch_many(self, symbols):
+        """
+        Download the 1-day history of several symbols in one grouped request,
+        - Returns a dictionary symbol -> latest closing price,
+        - Symbols that yfinance returns no data for are left out.
+        """
+        data = _yfinance().download(symbols, period="1d", group_by="ticker",
+                                    auto_adjust=True, progress=False,
+                                    threads=True)
+        closes = {}
+        if data is None or data.empty:
+            return closes
+        for symbol in symbols:
+            try:
+                column = data[symbol]['Close']
+            except KeyError:
+                continue
+            column = column.dropna()
+            if not column.empty:
+                closes[symbol] = float(column.iloc[-1])
+        return closes
+
+
+class HistoryProvider:
+    """
+    Serves the last closing prices of the local price history, no network
+    is needed.
+    """
+    def fetch(self, symbol):
+        closes = self.fetch_many([symbol])
+        if symbol not in closes:
+            raise QuoteError(f"No stored price for {symbol}")
+        return closes[symbol]
+
+    def fetch_many(self, symbols):
+        from history import get_history_store
+        store = get_history_store()
+        closes = {}
+        for symbol in symbols:
+            price = store.price(symbol)
+            if price is not None:
+                closes[symbol] = price
+        return closes
+
+
+class RecordingProvider:
+    def __init__(self, provider, path=QUOTE_RECORD):
+        """
+        Passes every call on to `provider` and appends one JSON line per
+        call to `path` with the symbols, the returned prices, the latency
+        in seconds and the error if the call failed.
+        """
+        self.provider = provider
+        self.path = path
+        self.lock = threading.Lock()
+
+    def _call(self, method, symbols, *arguments):
+        start = time.perf_counter()
+        prices = {}
+        error = None
+        try:
+            result = getattr(self.provider, method)(*arguments)
+            prices = result if method == "fetch_many" else {
+                symbols[0]: result}
+            return result
+        except Exception as exception:
+            error = repr(exception)
+            raise
+        finally:
+            line = json.dumps({
+                "call": method,
+                "symbols": symbols,
+                "prices": prices,
+                "latency": time.perf_counter() - start,
+                "error": error
+            })
+            with self.lock, open(self.path, "a") as file:
+                file.write(line + "\n")
+
+    def fetch(self, symbol):
+        return self._call("fetch", [symbol], symbol)
+
+    def fetch_many(self, symbols):
+        symbols = list(symbols)
+        return self._call("fetch_many", symbols, symbols)
+
+
+class ReplayProvider:
+    def __init__(self, path=QUOTE_REPLAY_FILE, latency=QUOTE_REPLAY_LATENCY,
+                 error_rate=QUOTE_REPLAY_ERROR_RATE, seed=QUOTE_REPLAY_SEED):
+        """
+        Serves the prices of a recording made by RecordingProvider,
+        - The prices recorded for each symbol are returned in turn, starting
+          over after the last one,
+        - Each call sleeps `latency` seconds, or a latency drawn from the
+          recorded ones when `latency` is None,
+        - A share `error_rate` of the calls raises QuoteError,
+        - Latencies and errors are drawn from a generator seeded with
+          `seed`, so a run can be reproduced.
+        """
+        self.prices = {}
+        self.latencies = {"fetch": [], "fetch_many": []}
+        with open(path, "r") as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                call = json.loads(line)
+                self.latencies[call["call"]].append(call["latency"])
+                for symbol, price in call["prices"].items():
+                    self.prices.setdefault(symbol, []).append(price)
+        self.latency = None if latency is None else float(latency)
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.positions = {}
+        self.lock = threading.Lock()
+
+    def _wait(self, method):
+        """
+        Sleeps for the latency of one call and raises the injected errors.
+        """
+        with self.lock:
+            recorded = self.latencies[method] or self.latencies["fetch"]
+            if self.latency is not None:
+                delay = self.latency
+            else:
+                delay = self.random.choice(recorded) if recorded else 0
+            failed = self.random.random() < self.error_rate
+        time.sleep(delay)
+        if failed:
+            raise QuoteError("Injected quote error")
+
+    def _price(self, symbol):
+        recorded = self.prices.get(symbol)
+        if not recorded:
+            return None
+        with self.lock:
+            position = self.positions.get(symbol, 0)
+            self.positions[symbol] = position + 1
+        return recorded[position % len(recorded)]
+
+    def fetch(self, symbol):
+        self._wait("fetch")
+        price = self._price(symbol)
+        if price is None:
+            raise QuoteError(f"No recorded price for {symbol}")
+        return price
+
+    def fetch_many(self, symbols):
+        self._wait("fetch_many")
+        closes = {}
+        for symbol in symbols:
+            price = self._price(symbol)
+            if price is not None:
+                closes[symbol] = price
+        return closes
+
+
+_provider = None
+_provider_lock = threading.Lock()
+
+
+def get_quote_provider():
+    """
+    Returns the process-wide provider selected by QUOTE_SOURCE, wrapped in
+    a RecordingProvider when QUOTE_RECORD is set, creating it on first use.
+    """
+    global _provider
+    with _provider_lock:
+        if _provider is None:
+            if QUOTE_SOURCE == "history":
+                _provider = HistoryProvider()
+            elif QUOTE_SOURCE == "replay":
+                _provider = ReplayProvider()
+            else:
+                _provider = YFinanceProvider()
+            if QUOTE_RECORD:
+                _provider = RecordingProvider(_provider)
+    return _provider
+
+
+def set_quote_provider(provider):
+    """
+    Replaces the process-wide provider, for tests and benchmarks.
+    """
+    global _provider
+    with _provider_lock:
+        _provider = provider
@@ -0,0 +1,327 @@
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from metrics import timed
+from providers import get_quote_provider
+
+# Maximum number of symbols sent to the quote provider in one request.
+BULK_CHUNK_SIZE = 200
+# Number of seconds a cached quote is served before it is fetched again.
+QUOTE_TTL = float(os.getenv("QUOTE_TTL", "60"))
+# Maximum number of symbols kept in the quote cache.
+QUOTE_CACHE_SIZE = int(os.getenv("QUOTE_CACHE_SIZE", "1024"))
+# Number of worker threads fetching single quotes concurrently.
+QUOTE_WORKERS = int(os.getenv("QUOTE_WORKERS", "8"))
+# Number of seconds a concurrent valuation waits for its single quotes.
+QUOTE_TIMEOUT = float(os.getenv("QUOTE_TIMEOUT", "10"))
+# Number of seconds a cached quote is recent enough for a trade, which the
+# background refresher (refresher.py) keeps the hot symbols within, 0 makes
+# every trade wait for a live price.
+QUOTE_TRADE_AGE = float(os.getenv("QUOTE_TRADE_AGE", "30"))
+
+
+class QuoteCache:
+    def __init__(self, ttl=QUOTE_TTL, max_size=QUOTE_CACHE_SIZE):
+        """
+        Initializes an empty quote cache,
+        - `ttl` is the freshness window of a quote in seconds,
+        - `max_size` bounds the number of symbols kept, the least recently
+          used symbol is evicted first.
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        # symbol -> weak references to the objects notified through
+        # on_quote(symbol, price)
+        self.watchers = {}
+
+    def watch(self, symbol, watcher):
+        """
+        Calls `watcher.on_quote(symbol, price)` whenever a new price of the
+        symbol is stored, the watcher is only weakly referenced,
+        Python keeps one plain weak reference per object, so a watcher of
+        many symbols costs one set entry per symbol, references to dead
+        watchers are dropped whenever a set doubles in size.
+        """
+        with self.lock:
+            refs = self.watchers.get(symbol)
+            if refs is None:
+                refs = self.watchers[symbol] = set()
+            refs.add(weakref.ref(watcher))
+            if len(refs) >= 8 and len(refs) & (len(refs) - 1) == 0:
+                refs.difference_update([ref for ref in refs if ref() is None])
+
+    def get(self, symbol, max_age=None):
+        """
+        Returns the cached price of the symbol if it is still fresh, at most
+        `max_age` seconds old (the ttl by default), otherwise None. Expired
+        entries are counted as stale and kept as the last known price until
+        they are replaced or evicted.
+        """
+        if max_age is None:
+            max_age = self.ttl
+        with self.lock:
+            entry = self.entries.get(symbol)
+            if entry is None:
+                self.misses += 1
+                return None
+            price, stored_at = entry
+            if time.monotonic() - stored_at > max_age:
+                self.stale += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(symbol)
+            return price
+
+    def age(self, symbol):
+        """
+        Returns the number of seconds since the symbol was priced, or None.
+        """
+        with self.lock:
+            entry = self.entries.get(symbol)
+            return time.monotonic() - entry[1] if entry else None
+
+    def last_known(self, symbol):
+        """
+        Returns the cached price of the symbol whatever its age, or None.
+        """
+        with self.lock:
+            entry = self.entries.get(symbol)
+            return entry[0] if entry else None
+
+    def put(self, symbol, price):
+        """
+        Stores the price of the symbol, evicts the least recently used
+        symbols when the cache is over its maximum size and notifies the
+        watchers of the symbol.
+        """
+        with self.lock:
+            self.entries[symbol] = (price, time.monotonic())
+            self.entries.move_to_end(symbol)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+            watchers = []
+            for ref in list(self.watchers.get(symbol, ())):
+                watcher = ref()
+                if watcher is None:
+                    self.watchers[symbol].discard(ref)
+                else:
+                    watchers.append(watcher)
+        for watcher in watchers:
+            watcher.on_quote(symbol, price)
+
+    def clear(self):
+        """
+        Removes every cached quote, the counters are kept.
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """
+        Returns the cache counters as a dictionary.
+        """
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "evictions": self.evictions
+            }
+
+
+quote_cache = QuoteCache()
+
+
+def _fetch_stock_price(symbol):
+    """
+    Retrieve the latest closing stock price for a given symbol from the
+    quote provider (see providers.py).
+    """
+    return get_quote_provider().fetch(symbol)
+
+
+@timed("get_stock_price")
+def get_stock_price(symbol, fresh=False):
+    """
+    Retrieve the latest closing stock price for a given symbol,
+    - The quote cache is consulted first,
+    - Trades pass `fresh=True` so they are executed at a price at most
+      QUOTE_TRADE_AGE seconds old,
+    - The fetched price is stored in the cache for later lookups.
+    """
+    max_age = QUOTE_TRADE_AGE if fresh else None
+    if max_age != 0:
+        price = quote_cache.get(symbol, max_age)
+        if price is not None:
+            return price
+    return _fetch_shared(symbol)
+
+
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+def _fetch_shared(symbol):
+    """
+    Fetch a live price and store it in the quote cache,
+    Callers asking for a symbol that is already being fetched wait for that
+    request instead of sending their own.
+    """
+    with _in_flight_lock:
+        future = _in_flight.get(symbol)
+        owner = future is None
+        if owner:
+            future = Future()
+            _in_flight[symbol] = future
+    if not owner:
+        return future.result()
+    try:
+        price = _fetch_stock_price(symbol)
+        quote_cache.put(symbol, price)
+        future.set_result(price)
+        return price
+    except Exception as error:
+        future.set_exception(error)
+        raise
+    finally:
+        with _in_flight_lock:
+            del _in_flight[symbol]
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _quote_executor():
+    """
+    Returns the bounded worker pool used for single quotes.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=QUOTE_WORKERS,
+                                           thread_name_prefix="quote")
+    return _executor
+
+
+def _fetch_concurrently(symbols, timeout=QUOTE_TIMEOUT):
+    """
+    Fetch single quotes for the symbols on the worker pool,
+    - All requests run at the same time and share one `timeout` deadline,
+    - Returns the dictionary of fetched prices and the list of symbols
+      whose request failed or did not finish in time.
+    """
+    futures = {symbol: _quote_executor().submit(_fetch_shared, symbol)
+               for symbol in symbols}
+    deadline = time.monotonic() + timeout
+    prices = {}
+    failed = []
+    for symbol, future in futures.items():
+        try:
+            prices[symbol] = future.result(
+                timeout=max(0, deadline - time.monotonic()))
+        except Exception:
+            failed.append(symbol)
+    return prices, failed
+
+
+def _chunks(symbols, size):
+    """
+    Split the sorted list of symbols into lists of at most `size` symbols.
+    """
+    for start in range(0, len(symbols), size):
+        yield symbols[start:start + size]
+
+
+def _download_closes(symbols):
+    """
+    Retrieve the latest closing prices of several symbols with one request
+    to the quote provider,
+    - Returns a dictionary symbol -> latest closing price,
+    - Symbols that the provider has no price for are left out.
+    """
+    return get_quote_provider().fetch_many(symbols)
+
+
+@timed("price_symbols")
+def price_symbols(symbols, chunk_size=BULK_CHUNK_SIZE, fresh=False):
+    """
+    Retrieve the latest closing prices for a set of symbols, tolerating
+    failures,
+    - Fresh cached quotes are used, only those at most QUOTE_TRADE_AGE
+      seconds old when `fresh` is True,
+    - The remaining symbols are grouped into chunks of `chunk_size` and each
+      chunk is resolved with a single yfinance download,
+    - Symbols missing from the grouped result, or whose chunk failed, are
+      fetched concurrently on a bounded worker pool,
+    - Symbols that still have no price get their last known price,
+    - Returns the dictionary symbol -> price, the set of symbols priced with
+      their last known price, and the set of symbols without any price.
+    """
+    symbols = sorted(set(symbols))
+    prices = {}
+    max_age = QUOTE_TRADE_AGE if fresh else None
+    if max_age != 0:
+        for symbol in symbols:
+            price = quote_cache.get(symbol, max_age)
+            if price is not None:
+                prices[symbol] = price
+    missing = [symbol for symbol in symbols if symbol not in prices]
+    for chunk in _chunks(missing, chunk_size):
+        try:
+            closes = _download_closes(chunk)
+        except Exception:
+            # The symbols of the chunk are fetched one by one below.
+            continue
+        for symbol, price in closes.items():
+            quote_cache.put(symbol, price)
+            prices[symbol] = price
+    missing = [symbol for symbol in missing if symbol not in prices]
+    fetched, failed = _fetch_concurrently(missing)
+    prices.update(fetched)
+    stale = set()
+    unavailable = set()
+    for symbol in failed:
+        price = quote_cache.last_known(symbol)
+        if price is None:
+            unavailable.add(symbol)
+        else:
+            prices[symbol] = price
+            stale.add(symbol)
+    return prices, stale, unavailable
+
+
+@timed("refresh_quotes")
+def refresh_quotes(symbols, chunk_size=BULK_CHUNK_SIZE):
+    """
+    Re-prices the symbols with grouped requests only and stores the prices
+    in the quote cache,
+    - Returns the dictionary symbol -> price,
+    - A failed chunk does not stop the others, its error is raised once
+      every chunk was tried.
+    """
+    prices = {}
+    error = None
+    for chunk in _chunks(sorted(set(symbols)), chunk_size):
+        try:
+            closes = _download_closes(chunk)
+        except Exception as exception:
+            error = exception
+            continue
+        for symbol, price in closes.items():
+            quote_cache.put(symbol, price)
+            prices[symbol] = price
+    if error is not None:
+        raise error
+    return prices
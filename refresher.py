@@ -0,0 +1,126 @@
+"""
+Background refresher keeping the quotes of the hot symbols warm,
+- Hot symbols are the ones held or ordered by the active portfolios (the
+  logged-in sessions), the ones with open orders, and the ones entered in
+  the buy, sell and order prompts in the last QUOTE_REFRESH_RECENT seconds,
+- Every QUOTE_REFRESH_INTERVAL seconds the hot symbols are re-priced with
+  grouped requests and published in the quote cache, which get_stock_price
+  and the status screen read first, so they rarely wait for the network,
+- A symbol entered in a prompt is priced right away, while the user types
+  the quantity,
+- After a failed refresh the next one waits twice as long, up to
+  QUOTE_REFRESH_MAX_BACKOFF seconds.
+"""
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from metrics import increment
+from orders import order_book
+from quotes import quote_cache, refresh_quotes
+
+# Number of seconds between two refreshes, 0 disables the refresher.
+QUOTE_REFRESH_INTERVAL = float(os.getenv("QUOTE_REFRESH_INTERVAL", "15"))
+# Number of seconds a symbol entered in a prompt stays hot.
+QUOTE_REFRESH_RECENT = float(os.getenv("QUOTE_REFRESH_RECENT", "600"))
+# Longest wait after failed refreshes, in seconds.
+QUOTE_REFRESH_MAX_BACKOFF = float(os.getenv("QUOTE_REFRESH_MAX_BACKOFF",
+                                            "300"))
+
+
+class QuoteRefresher:
+    def __init__(self, interval=QUOTE_REFRESH_INTERVAL,
+                 recent=QUOTE_REFRESH_RECENT,
+                 max_backoff=QUOTE_REFRESH_MAX_BACKOFF):
+        """
+        Idle until a portfolio is tracked or a symbol touched, the thread
+        is then started.
+        """
+        self.interval = interval
+        self.recent = recent
+        self.max_backoff = max_backoff
+        self.portfolios = weakref.WeakSet()
+        # symbol -> time it was last entered, oldest first
+        self.touched = OrderedDict()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.delay = interval
+        self.thread = None
+
+    def _start(self):
+        if self.thread is None and self.interval > 0:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def track(self, portfolio):
+        """
+        Keeps the holdings and orders of the portfolio warm while it is
+        logged in, it is only weakly referenced.
+        """
+        with self.lock:
+            self.portfolios.add(portfolio)
+            self._start()
+
+    def forget(self, portfolio):
+        with self.lock:
+            self.portfolios.discard(portfolio)
+
+    def touch(self, symbol):
+        """
+        Marks a symbol entered by the user as hot and prices it in the
+        background if its cached quote is not recent.
+        """
+        with self.lock:
+            self.touched[symbol] = time.monotonic()
+            self.touched.move_to_end(symbol)
+            self._start()
+        age = quote_cache.age(symbol)
+        if age is None or age >= self.interval:
+            self.wake.set()
+
+    def symbols(self):
+        """
+        Returns the set of hot symbols, dropping the touched symbols that
+        went cold.
+        """
+        cold = time.monotonic() - self.recent
+        with self.lock:
+            while self.touched and next(iter(self.touched.values())) < cold:
+                self.touched.popitem(last=False)
+            symbols = set(self.touched)
+            portfolios = list(self.portfolios)
+        for portfolio in portfolios:
+            symbols.update(portfolio.stock)
+            symbols.update(order.symbol
+                           for order in list(portfolio.orders.values()))
+        symbols.update(order_book.symbols())
+        return symbols
+
+    def refresh(self):
+        """
+        Re-prices the hot symbols whose quote is older than half the
+        interval, returns the number of symbols priced.
+        """
+        due = []
+        for symbol in self.symbols():
+            age = quote_cache.age(symbol)
+            if age is None or age >= self.interval / 2:
+                due.append(symbol)
+        if not due:
+            return 0
+        return len(refresh_quotes(due))
+
+    def _run(self):
+        while True:
+            self.wake.wait(self.delay)
+            self.wake.clear()
+            try:
+                self.refresh()
+                self.delay = self.interval
+            except Exception:
+                increment("quotes.refresh_errors")
+                self.delay = min(self.delay * 2, self.max_backoff)
+
+
+quote_refresher = QuoteRefresher()
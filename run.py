@@ -1,315 +1,680 @@
-import json
-import yfinance as yf
+import argparse
 import os
-import requests
+import signal
 import sys
-try:
-    import env  # only exists locally
-    GITHUB_TOKEN = env.key
-    GIST_ID = env.GIST_ID
-except ImportError:
-    GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
-    GIST_ID = os.getenv("GIST_ID")
+import threading
+import time
+import analytics
+from holdings import Holdings, price_vector
+from ledger import apply_event, get_ledger, next_order
+from metrics import end_session, timed
+from orders import KINDS, SIDES, Order, order_book
+from profiling import PROFILE_DIR, profiler
+from quotes import get_stock_price, price_symbols, quote_cache
+from refresher import quote_refresher
+from storage import DURABILITY, get_store, write_behind
+from symbols import get_symbol_index
+
+# Number of seconds after which the status screen re-prices every holding
+# instead of using the incrementally maintained account value.
+VALUATION_MAX_AGE = float(os.getenv("VALUATION_MAX_AGE", "300"))
+# Empty set of symbols shared by the portfolios that were not valued yet.
+NO_SYMBOLS = frozenset()
 
 
 if sys.platform.startswith('win'):
     import msvcrt
 
-    def get_key():
+    def read_key():
         return msvcrt.getch()
 else:
     import getch
 
-    def get_key():
+    def read_key():
         return getch.getch()
 
 
+def get_key():
+    """
+    Wait for a single key press,
+    Session terminals of the asyncio server (server.py) replace sys.stdin
+    and read the key from their connection instead.
+    """
+    if hasattr(sys.stdin, "get_key"):
+        return sys.stdin.get_key()
+    return read_key()
+
+
+@timed("terminal.redraw")
 def clear_terminal():
     """
     Clear the terminal screen based on the operating system,
+    For server sessions, the session terminal clears itself,
     For Windows, run the 'cls' command,
     For Mac and Linux, run the 'clear' command,
     """
-    if os.name == 'nt':
+    if hasattr(sys.stdout, "clear_screen"):
+        sys.stdout.clear_screen()
+    elif os.name == 'nt':
         os.system('cls')
     else:
         os.system('clear')
 
 
-def get_stock_price(symbol):
+@timed("get_symbol_list")
+def get_symbol_list():
     """
-    Retrieve the latest closing stock price for a given symbol,
-    - Create a Ticker object for the given stock symbol using yfinance,
-    - Retrieve the historical price data for the stock for a 1-day period,
-    - Access the closing price for the most recent day available,
-    - The closing stock price as a float or numeric value.
+    Retrieve the index of stock symbols,
+    - The index is built from 'stock_list.txt' once per process (through
+      its precompiled copy 'stock_list.idx'),
+    - It supports `symbol in symbol_list` membership tests in constant time
+      and prefix searches for suggestions.
     """
-    stock = yf.Ticker(symbol)
-    stock_price = stock.history(period="1d")['Close'].iloc[0]
-    return stock_price
+    return get_symbol_index()
 
 
-def get_symbol_list():
+def print_invalid_symbol(symbol, symbol_list):
     """
-    Retrieve a list of stock symbols from a local file,
-    - Open the file 'stock_list.txt' in read mode,
-    - Load the contents of the file as JSON data and store it in symbol_list,
-    - The list of stock symbols.
+    Tell the user the symbol is unknown and suggest close symbols if any.
     """
-    with open('stock_list.txt', 'r') as file:
-        symbol_list = json.load(file)
-    return symbol_list
+    print("The symbol you entered is invalid!")
+    suggestions = symbol_list.suggest(symbol)
+    if suggestions:
+        print(f"Did you mean: {', '.join(suggestions)}?")
+
+
+def enable_symbol_completion(symbol_list):
+    """
+    Complete partial symbols with the tab key where readline is available.
+    """
+    try:
+        import readline
+    except ImportError:
+        return
+
+    def complete(text, state):
+        matches = symbol_list.prefix(text.upper(), 50)
+        return matches[state] if state < len(matches) else None
 
+    readline.set_completer(complete)
+    readline.parse_and_bind("tab: complete")
 
+
+@timed("load_creds")
 def load_creds():
-    url = f"https://api.github.com/gists/{GIST_ID}"
-    headers = {"Authorization": f"token {GITHUB_TOKEN}"}
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        json_file_url = response.json()["files"]["creds.json"]["raw_url"]
-        creds = requests.get(json_file_url).json()
-    else:
-        print("Failed to fetch Gist:", response.status_code)
-    return creds
+    """
+    Load the list of all user accounts from the configured storage backend
+    (the GitHub Gist by default, or the local SQLite database).
+    """
+    return get_store().load_all()
 
 
+@timed("save_creds")
 def save_creds(creds):
     """
-    Save updated credentials to the environment variable,
-    Converts the dictionary to JSON and updates the CREDS_JSON environment
-    variable,
-    Gist API URL,
-    Gist update payload,
-    Authorization header,
-    Send PATCH request to update the Gist.
+    Save the full list of user accounts to the configured storage backend.
     """
-    creds_json = json.dumps(creds)
-    url = f"https://api.github.com/gists/{GIST_ID}"
-    payload = {
-        "files": {
-            "creds.json": {
-                "content": creds_json
-            }
-        }
-    }
-    headers = {
-        "Authorization": f"token {GITHUB_TOKEN}",
-        "Content-Type": "application/json"
-    }
-    response = requests.patch(url, headers=headers, json=payload)
+    get_store().save_all(creds)
 
 
 def assign_id():
     """
-    Assigns a unique ID to a new user by scanning existing user data from a
-    file,
-    Attempts to load existing user data from the file `creds.json`,
-       - If the file doesn't exist or contains invalid JSON, initializes an
-         empty list.
-    Iterates over the list of users to find the highest existing ID,
-       - Assumes that each user in the list has an "id" field containing a
-         numeric value.
-    Increments the highest ID by one and returns it as the new unique ID,
-    The next available numeric ID (highest ID in the data incremented by 1).
+    Assigns a unique ID to a new user,
+    The storage backend keeps a persisted id counter, so no user data has to
+    be scanned, and the counter never hands out an id below the highest
+    existing one.
     """
-    data = load_creds()
-    id_assigned = 0
-    for user in data:
-        id_assigned = int(user["id"])
-    id_assigned += 1
-    return id_assigned
+    return get_store().next_id()
 
 
+@timed("load_portfolio")
 def load_portfolio(pin, password):
     """
-    Loads a user's portfolio from the existing data file based on the provided
+    Loads a user's portfolio from the storage backend based on the provided
     PIN and password,
-    Attempts to load user data from the file `creds.json`:
-       - If the file does not exist or contains invalid JSON, initializes an
-         empty list (`data`).
-    Iterates through the list of user dictionaries to find a match for the
-    provided PIN and password,
-       - If a match is found:
-         - Initializes a `Portfolio` object with the user's information.
-         - Sets the portfolio attributes (`stock`, `investment`,
-           `account_value`, and `buying_power`) based on the matched user data.
-         - Calls the `save_update` method on the `Portfolio` object to save
-           or update its data.
+    Looks the account up by its id (the PIN):
+       - If the account exists and the password matches:
+         - Builds the `Portfolio` object from the matched user data with
+           `portfolio_from_record`.
          - Prints a success message and returns `True` along with the
            `Portfolio` object.
-       - If no match is found:
-         - Prints an error message indicating that the user ID or password
-           is incorrect.
-         - Returns `False` and an empty list.
+       - Otherwise returns `False` and an empty list.
     """
-    data = load_creds()
-    for user in data:
-        if user["id"] == pin and user["password"] == password:
-            my_portfolio = Portfolio(1000, password, pin)
-            my_portfolio.stock = user["stock"]
-            my_portfolio.investment = user["investment"]
-            my_portfolio.account_value = user["account_value"]
-            my_portfolio.buying_power = user["buying_power"]
-            my_portfolio.save_update()
-            print("Your account login was successful!!")
-            return True, my_portfolio
+    user = get_store().get(pin)
+    if user is not None and user["password"] == password:
+        my_portfolio = portfolio_from_record(user)
+        print("Your account login was successful!!")
+        return True, my_portfolio
     return False, []
 
 
+def portfolio_from_record(user):
+    """
+    Builds the `Portfolio` object of a stored user record without saving it,
+    With the ledger enabled, the stored record is the snapshot and the
+    operations logged after it are replayed on top of it.
+    """
+    ledger = get_ledger()
+    if ledger is not None:
+        user = ledger.replay(user)
+    my_portfolio = Portfolio(1000, user["password"], user["id"], save=False)
+    my_portfolio.ledger_seq = user.get("ledger_seq", 0)
+    my_portfolio.version = user.get("version", 0)
+    my_portfolio.stock = Holdings(user["stock"])
+    my_portfolio.investment = user["investment"]
+    my_portfolio.account_value = user["account_value"]
+    my_portfolio.buying_power = user["buying_power"]
+    for symbol in my_portfolio.stock:
+        quote_cache.watch(symbol, my_portfolio)
+    my_portfolio.next_order = next_order(user)
+    for record in user.get("orders", ()):
+        order = Order.from_record(record, my_portfolio)
+        my_portfolio.orders[order.id] = order
+        order_book.add(order)
+    return my_portfolio
+
+
+def filled(order):
+    """
+    Returns the event details linking a trade to the order it fills.
+    """
+    return {} if order is None else {"order": order.id}
+
+
+def describe(event):
+    """
+    Returns the wording of a withdrawal, purchase or sale event.
+    """
+    if event["type"] == "withdraw":
+        return f"withdrawal of {event['amount']}"
+    action = "purchase" if event["type"] == "buy" else "sale"
+    return f"{action} of {event['quantity']} {event['symbol']}"
+
+
 class Portfolio:
+    # Servers keep many portfolios loaded, slots leave out the per-object
+    # dictionary, __weakref__ lets the quote cache and the refresher watch
+    # portfolios without keeping them alive.
+    __slots__ = ("stock", "investment", "account_value", "buying_power",
+                 "password", "id", "creds", "ledger_seq", "version",
+                 "unsaved", "unwritten", "orders", "next_order", "fills",
+                 "stale_prices", "unpriced", "market_value", "valued_at",
+                 "autosave", "lock", "__weakref__")
+
+    @timed("portfolio.create")
     def __init__(self, investment=0, password='none', number=-1,
-                 creds='creds.json'):
+                 creds='creds.json', save=True):
         """
-        Initializes a Portfolio object with a given investment amount
+        Initializes a Portfolio object with a given investment amount,
+        `save=False` skips the initial save for portfolios loaded from storage
         """
-        self.stock = {}
+        # Quotes, fills and the write-behind buffer reach the portfolio from
+        # other threads, every change is made under this lock, which is
+        # never held while fetching prices or writing to storage.
+        self.lock = threading.RLock()
+        self.stock = Holdings()
         self.investment = investment
         self.account_value = investment
         self.buying_power = investment
         self.password = password
         self.id = number
         self.creds = creds
+        self.ledger_seq = 0
+        # Version of the stored record this portfolio is based on, the
+        # operations made since it was last saved, which are replayed onto
+        # the stored record when another session changed it meanwhile, and
+        # those not written yet, saved or not.
+        self.version = 0
+        self.unsaved = []
+        self.unwritten = []
+        # Open limit and stop orders by number, the number of the next one,
+        # which is stored so that numbers are never reused, and the
+        # messages of the orders filled or rejected since the last status.
+        self.orders = {}
+        self.next_order = 1
+        self.fills = []
+        self.stale_prices = NO_SYMBOLS
+        self.unpriced = NO_SYMBOLS
+        # Running valuation: the sum of the position values kept in
+        # `stock`, and when every position was last priced together.
+        self.market_value = 0
+        self.valued_at = None
+        # Batch runs turn this off and persist every portfolio once at the
+        # end instead of on each operation.
+        self.autosave = True
         """
         Save or update user info in the creds.json file
         """
-        self.save_update()
-
-    def save_update(self):
-        """
-        Saves the current user's data to the file or updates it if the user
-        already exists,
-        Loads existing user data from the file specified in `self.creds`:
-       - If the file does not exist or contains invalid JSON, initializes
-         an empty list (`data`).
-        Searches for the user in the loaded data by comparing their unique
-        identifier (`self.id`):
-       - If a match is found:
-         - Updates the existing user's data with the current instance
-           attributes,
-       - If no match is found:
-         - Appends a new dictionary containing the current user's data
-           to the list,
-        Writes the updated list of user data back to the file:
-       - Saves the data in a human-readable JSON format with an indentation
-         of 4 spaces.
-        """
-        data = load_creds()
-        user_found = False
-        for user in data:
-            if user["id"] == self.id:
-                user["stock"] = self.stock
-                user["investment"] = self.investment
-                user["account_value"] = self.account_value
-                user["buying_power"] = self.buying_power
-                user["password"] = self.password
-                user_found = True
-                break
-        if not user_found:
-            data.append({
-                "stock": self.stock,
+        if save:
+            self.record_event("deposit", sync=True, amount=investment)
+
+    @timed("portfolio.to_record")
+    def to_record(self):
+        """
+        Returns the dictionary stored for this user in the storage backend.
+        """
+        with self.lock:
+            return {
+                "stock": self.stock.to_dict(),
                 "investment": self.investment,
                 "account_value": self.account_value,
                 "buying_power": self.buying_power,
                 "password": self.password,
                 "id": self.id,
-                "creds": self.creds
-            })
-        save_creds(data)
+                "creds": self.creds,
+                "ledger_seq": self.ledger_seq,
+                "version": self.version,
+                "orders": [order.to_record()
+                           for order in self.orders.values()],
+                "next_order": self.next_order
+            }
+
+    @timed("portfolio.save_update")
+    def save_update(self, sync=False):
+        """
+        Saves the current user's data to the storage backend or updates it if
+        the user already exists,
+        Only this user's record is written, the backend replaces the stored
+        record with the same id (`self.id`) or inserts a new one,
+        The write is queued in the write-behind buffer and coalesced with
+        later saves, unless `sync` is True and DURABILITY is "strict", in
+        which case it is written before returning,
+        The record is queued under the portfolio lock, in the order the
+        changes were made, a synchronous write is made after releasing it
+        since the writing thread takes the lock to hand back the new version
+        (see `stored`),
+        Nothing is saved while `autosave` is off.
+        """
+        with self.lock:
+            if not self.autosave:
+                return
+            record = self.to_record()
+            events, self.unsaved = self.unsaved, []
+            write_behind.schedule(record, events, owner=self)
+        if sync and DURABILITY == "strict":
+            write_behind.write_now(self.id, owner=self)
+
+    def stored(self, version, written, merged, rejected):
+        """
+        Called once the record is written as `version` with the operations
+        `written`, `merged` is the written record when operations of another
+        session were merged into it, the portfolio then takes over its
+        holdings, balances and open orders, with the operations it made
+        since applied again on top, and is valued again on the next status,
+        The operations of this session that the merge had to drop
+        (`rejected`) are reported on the next status, and marked in the
+        ledger with a "rejected" event so that reports leave them out.
+        """
+        with self.lock:
+            self.version = version
+            # Operations are written in the order they were made.
+            del self.unwritten[:len(written)]
+            for event in rejected:
+                self.fills.append(f"Your {describe(event)} was undone "
+                                  f"because the account changed in another "
+                                  f"session and {event['reason']}.")
+                if "seq" in event:
+                    self.log_event("rejected", event_seq=event["seq"])
+            if merged is None:
+                return
+            merged = dict(merged, stock=dict(merged["stock"]),
+                          orders=list(merged.get("orders", ())))
+            renumbered = {}
+            for event in self.unwritten:
+                apply_event(merged, event, renumbered)
+            self.stock = Holdings(merged["stock"])
+            self.investment = merged["investment"]
+            self.buying_power = merged["buying_power"]
+            self.account_value = merged["account_value"]
+            self.ledger_seq = merged.get("ledger_seq", self.ledger_seq)
+            self.market_value = 0
+            self.valued_at = None
+            for symbol in self.stock:
+                quote_cache.watch(symbol, self)
+            self.next_order = max(self.next_order, next_order(merged))
+            # The merge may have renumbered orders, an order is kept only
+            # when its number still holds the same order.
+            orders = {}
+            for record in merged.get("orders", ()):
+                order = self.orders.get(record["id"])
+                if order is None or order.to_record() != record:
+                    order = Order.from_record(record, self)
+                    order_book.add(order)
+                orders[order.id] = order
+            for number, order in self.orders.items():
+                if number not in orders:
+                    order_book.cancel(order)
+            self.orders = orders
+
+    def not_stored(self, reason):
+        """
+        Called when the record of this new account could not be written, the
+        portfolio stops saving and the reason is reported on the next status.
+        """
+        with self.lock:
+            self.autosave = False
+            self.fills.append(f"Your account could not be saved because "
+                              f"{reason}.")
 
-    def buy_stock(self, symbol, number):
+    def log_event(self, event_type, **details):
+        """
+        Appends a money-moving operation to the ledger, when it is enabled,
+        and to the operations waiting to be saved, under the portfolio lock
+        so that both keep the order the changes were made in.
+        """
+        ledger = get_ledger()
+        event = dict(details, type=event_type)
+        with self.lock:
+            if ledger is not None:
+                self.ledger_seq = ledger.append(self.id, event)
+                event = dict(event, seq=self.ledger_seq)
+            self.unsaved.append(event)
+            self.unwritten.append(event)
+
+    def save_events(self, sync=False):
+        """
+        Saves the operations logged with `log_event`, see `record_event`.
+        """
+        self.save_update(sync=sync or get_ledger() is None)
+
+    @timed("portfolio.record_event")
+    def record_event(self, event_type, sync=False, **details):
+        """
+        Records a money-moving operation and saves the portfolio,
+        - With the ledger enabled (LEDGER_DIR), the operation is appended to
+          the account's log, which makes it durable, and the full record is
+          left to the write-behind buffer unless `sync` is True,
+        - Without the ledger, the record is saved as a money-moving write.
+        """
+        self.log_event(event_type, **details)
+        self.save_events(sync)
+
+    @timed("portfolio.buy_stock")
+    def buy_stock(self, symbol, number, price=None, order=None):
         """
         Purchases a specified number of shares of a given stock symbol if
         enough buying power is available,
-        Retrieves the current stock price using the get_stock_price function,
+        Retrieves a live stock price using the get_stock_price function,
+        unless the caller already fetched it and passes it as `price`,
         Calculates the total cost for purchasing the shares and checks if
         buying power is sufficient,
         If sufficient, updates the stock holdings and reduces the buying power
-        by the total cost.
+        by the total cost,
+        The price is fetched before taking the portfolio lock, storing it may
+        fill orders of other portfolios,
+        The messages of an `order` being filled are kept on the order,
+        Returns whether the purchase was made.
         """
-        stock_price = get_stock_price(symbol)
-        overall_price = stock_price * number
-        if self.buying_power >= overall_price:
-            if symbol in self.stock.keys():
-                self.stock[symbol] += number
-            else:
-                self.stock[symbol] = number
-            self.buying_power -= overall_price
-            print(f"You have successfully added {number} {symbol} to your "
-                  f"portfolio.")
-            self.save_update()
+        if price is None:
+            stock_price = get_stock_price(symbol, fresh=True)
         else:
-            print("You do not have enough buying power!")
-
-    def sell_stock(self, symbol, number):
+            stock_price = price
+        overall_price = stock_price * number
+        with self.lock:
+            bought = self.buying_power >= overall_price
+            if bought:
+                if symbol in self.stock.keys():
+                    self.stock[symbol] += number
+                else:
+                    self.stock[symbol] = number
+                    quote_cache.watch(symbol, self)
+                self.buying_power -= overall_price
+                self.revalue_position(symbol, stock_price)
+                self.log_event("buy", symbol=symbol, quantity=number,
+                               price=stock_price, **filled(order))
+        if not bought:
+            self.tell("You do not have enough buying power!", order)
+            return False
+        self.tell(f"You have successfully added {number} {symbol} to "
+                  f"your portfolio.", order)
+        self.save_events()
+        return True
+
+    def sale_problem(self, symbol, number):
+        """
+        Returns why `number` shares of `symbol` cannot be sold, or None.
+        """
+        if symbol not in self.stock:
+            return f"The stock symbol '{symbol}' is not in the portfolio."
+        if self.stock[symbol] < number:
+            return (f"You do not have enough number of '{symbol}' stocks "
+                    f"to sell")
+        return None
+
+    @timed("portfolio.sell_stock")
+    def sell_stock(self, symbol, number, price=None, order=None):
         """
         Checks if the specified stock symbol is in the portfolio,
         Ensures that there are enough shares available to sell; if not,
         displays an error message,
-        Fetches the current stock price using the get_stock_price function,
+        Fetches a live stock price using the get_stock_price function,
+        unless the caller already fetched it and passes it as `price`,
         Calculates the total amount received from selling the specified number
-        of shares and updates the buying power.
-        """
-        if symbol in self.stock:
-            if self.stock[symbol] >= number:
-                stock_price = get_stock_price(symbol)
-                overall_price = stock_price * number
-                self.buying_power += overall_price
-                self.stock[symbol] -= number
-                print(f"You have successfully sold {number} {symbol} from "
-                      f"your portfolio.")
-                self.save_update()
+        of shares and updates the buying power,
+        The shares are checked again under the portfolio lock once the price
+        is known, an order may have sold them meanwhile,
+        The messages of an `order` being filled are kept on the order,
+        Returns whether the sale was made.
+        """
+        problem = self.sale_problem(symbol, number)
+        if problem is None:
+            if price is None:
+                stock_price = get_stock_price(symbol, fresh=True)
             else:
-                print(f"You do not have enough number of '{symbol}' stocks to "
-                      f"sell")
+                stock_price = price
+            overall_price = stock_price * number
+            with self.lock:
+                problem = self.sale_problem(symbol, number)
+                if problem is None:
+                    self.buying_power += overall_price
+                    self.stock[symbol] -= number
+                    self.revalue_position(symbol, stock_price)
+                    self.log_event("sell", symbol=symbol, quantity=number,
+                                   price=stock_price, **filled(order))
+        if problem is not None:
+            self.tell(problem, order)
+            return False
+        self.tell(f"You have successfully sold {number} {symbol} "
+                  f"from your portfolio.", order)
+        self.save_events()
+        return True
+
+    def tell(self, message, order=None):
+        """
+        Prints the message, or keeps it on the order being filled, since
+        fills happen wherever the triggering quote arrived.
+        """
+        if order is None:
+            print(message)
+        else:
+            order.message = message
+
+    @timed("portfolio.place_order")
+    def place_order(self, side, kind, symbol, number, trigger):
+        """
+        Rests a limit or stop order in the order book (see orders.py),
+        The order is filled through buy_stock or sell_stock at the first
+        quote crossing `trigger`,
+        Returns the order.
+        """
+        with self.lock:
+            order = Order(self.next_order, side, kind, symbol, number,
+                          trigger, self)
+            self.next_order += 1
+            self.orders[order.id] = order
+            order_book.add(order)
+            self.log_event("order", **order.to_record())
+        print(f"Your order {order} was placed.")
+        self.save_events()
+        return order
+
+    @timed("portfolio.cancel_order")
+    def cancel_order(self, number):
+        """
+        Cancels the open order with the given number,
+        Returns whether it was cancelled.
+        """
+        with self.lock:
+            order = self.orders.pop(number, None)
+            cancelled = order is not None and order_book.cancel(order)
+            if cancelled:
+                self.log_event("cancel", order=number)
+        if not cancelled:
+            print(f"There is no open order #{number}.")
+            return False
+        print(f"Your order {order} was cancelled.")
+        self.save_events()
+        return True
+
+    @timed("portfolio.fill_order")
+    def fill_order(self, order, price):
+        """
+        Called by the order book when `price` triggered the order, buys or
+        sells at that price and keeps the outcome for the next status,
+        Fills run on the thread that stored the quote, the portfolio lock
+        is taken by every step but not held across the save.
+        """
+        with self.lock:
+            self.orders.pop(order.id, None)
+        if order.side == "buy":
+            done = self.buy_stock(order.symbol, order.quantity, price, order)
+        else:
+            done = self.sell_stock(order.symbol, order.quantity, price, order)
+        if done:
+            order.status = "filled"
         else:
-            print(f"The stock symbol '{symbol}' is not in the portfolio.")
+            order.status = "rejected"
+            self.record_event("cancel", order=order.id)
+        with self.lock:
+            self.fills.append(f"Your order {order} was {order.status} at "
+                              f"{price}: {order.message}")
+
+    @timed("portfolio.revalue_position")
+    def revalue_position(self, symbol, price):
+        """
+        Updates the running market value for one position at a new price,
+        only the difference with the previous value of the position is
+        applied.
+        """
+        with self.lock:
+            self.market_value += self.stock.set_price(symbol, price)
 
+    @timed("portfolio.on_quote")
+    def on_quote(self, symbol, price):
+        """
+        Called by the quote cache when a new price of a watched symbol is
+        stored, keeps the running valuation current without a full refresh.
+        """
+        with self.lock:
+            if symbol in self.stock:
+                self.revalue_position(symbol, price)
+
+    @timed("portfolio.valuation_expired")
+    def valuation_expired(self):
+        """
+        Tells whether the running valuation must be recomputed from scratch:
+        it never was, a holding has no price yet, or it is older than
+        VALUATION_MAX_AGE seconds,
+        The holdings the last valuation could not price (`unpriced`) are not
+        priced again before then, so an unknown symbol does not cost a quote
+        request on every status.
+        """
+        if self.valued_at is None:
+            return True
+        if time.monotonic() - self.valued_at > VALUATION_MAX_AGE:
+            return True
+        if self.stock.all_priced():
+            return False
+        return not self.stock.missing_prices() <= self.unpriced
+
+    @timed("portfolio.update_account_value")
     def update_account_value(self):
         """
         Updates the account value by recalculating it based on the current
-        buying power and the market value of all stocks held in the portfolio.
+        buying power and the market value of all stocks held in the portfolio,
+        All held symbols are priced together with one bulk quote request,
+        Symbols that could not be priced live keep their last known price
+        and are remembered in `stale_prices`, symbols without any known price
+        are left out and remembered in `unpriced`,
+        The running valuation is rebuilt from the new prices with one dot
+        product over the holdings arrays, the prices are fetched before
+        taking the portfolio lock.
         """
-        self.account_value = self.buying_power
-        for stock in self.stock:
-            stock_price = get_stock_price(stock)
-            self.account_value += stock_price * self.stock[stock]
-
+        prices, stale_prices, unpriced = price_symbols(self.stock)
+        vector = price_vector(prices)
+        with self.lock:
+            self.stale_prices, self.unpriced = stale_prices, unpriced
+            self.market_value = self.stock.revalue(vector)
+            self.valued_at = time.monotonic()
+            self.account_value = self.buying_power + self.market_value
+
+    @timed("portfolio.increase_investment")
     def increase_investment(self, amount):
         """
         Increases the portfolio's total investment and buying power by a
-        specified amount.
+        specified amount and returns True.
         """
-        self.investment += amount
-        self.buying_power += amount
+        with self.lock:
+            self.investment += amount
+            self.buying_power += amount
+            self.log_event("deposit", amount=amount)
         print(f"You have successfully added {amount} to your account.")
-        self.save_update()
+        self.save_events()
+        return True
 
+    @timed("portfolio.withdraw")
     def withdraw(self, amount):
         """
         Verifies that the portfolio has sufficient buying power to process
         the withdrawal,
-        If not, displays an error message.
+        If not, displays an error message,
+        Returns whether the withdrawal was made.
         """
-        if self.buying_power >= amount:
-            self.investment -= amount
-            self.buying_power -= amount
-            print(
-                f"You have successfully withdrawn {amount} from your "
-                f"account.")
-            self.save_update()
-        else:
+        with self.lock:
+            withdrawn = self.buying_power >= amount
+            if withdrawn:
+                self.investment -= amount
+                self.buying_power -= amount
+                self.log_event("withdraw", amount=amount)
+        if not withdrawn:
             print("You do not have enough liquidity!")
-
-    def print_status(self):
+            return False
+        print(
+            f"You have successfully withdrawn {amount} from your "
+            f"account.")
+        self.save_events()
+        return True
+
+    @timed("portfolio.print_status")
+    def print_status(self, refresh=False):
         """
         Prints the current status of the portfolio, including buying power,
-        account value, total investment, and stock holdings.
+        account value, total investment, and stock holdings,
+        The account value comes from the running valuation, every holding is
+        only priced again when `refresh` is True or the valuation expired.
         """
-        self.update_account_value()
-        print(f"Your buying power is : {self.buying_power}, "
-              f"your account is : {self.account_value}, "
-              f"your investment is : {self.investment}, "
-              f"and the stocks in your portfolio are : {self.stock}")
+        if refresh or self.valuation_expired():
+            self.update_account_value()
+        with self.lock:
+            self.account_value = self.buying_power + self.market_value
+            print(f"Your buying power is : {self.buying_power}, "
+                  f"your account is : {self.account_value}, "
+                  f"your investment is : {self.investment}, "
+                  f"and the stocks in your portfolio are : {self.stock}")
+            if self.stale_prices:
+                print(f"* The prices of "
+                      f"{', '.join(sorted(self.stale_prices))} could not be "
+                      f"updated, their last known price is used.")
+            if self.unpriced:
+                print(f"* The prices of {', '.join(sorted(self.unpriced))} "
+                      f"are not available, they are left out of your "
+                      f"account value.")
+            fills, self.fills = self.fills, []
+            for message in fills:
+                print(f"* {message}")
+            if self.orders:
+                print(f"Your open orders are : "
+                      f"{', '.join(map(str, self.orders.values()))}")
 
 
 def main():
@@ -331,8 +696,9 @@ def main():
                         input("Please enter your account id number: \n"))
                     password = input(
                         "Please enter your account's password: \n")
-                    flag_selection, my_portfolio = load_portfolio(id_number,
-                                                                  password)
+                    with profiler.scope("login"):
+                        flag_selection, my_portfolio = load_portfolio(
+                            id_number, password)
                     if not flag_selection:
                         print("Invalid ID number or password. "
                               "Please try again.")
@@ -350,8 +716,9 @@ def main():
                     else:
                         password = input(
                             "Please enter a password: \n")
-                        my_portfolio = Portfolio(initial_investment,
-                                                 password, assign_id())
+                        with profiler.scope("create"):
+                            my_portfolio = Portfolio(initial_investment,
+                                                     password, assign_id())
                         print(
                             f"Congratulations!! You have successfully created"
                             f"your portfolio!!")
@@ -376,19 +743,28 @@ def main():
         if flag_selection:
             selection = 100
             symbol_list = get_symbol_list()
+            enable_symbol_completion(symbol_list)
+            quote_refresher.track(my_portfolio)
             errorN = True
+            refresh_prices = False
             while errorN:
                 print("Press any key to continue...")
                 get_key()
                 clear_terminal()
-                my_portfolio.print_status()
+                with profiler.scope("status"):
+                    my_portfolio.print_status(refresh_prices)
+                refresh_prices = False
                 print(
                      "Which operation would you like to do? Please choose an "
                      "option by entering the corresponding number:\n1"
                      "- Buy a stock\n2"
                      "- Sell a stock\n3"
                      "- Increase your investment\n4"
-                     "- Withdraw from your account\n0"
+                     "- Withdraw from your account\n5"
+                     "- Refresh the prices of your stocks\n6"
+                     "- Show the risk and performance of your stocks\n7"
+                     "- Place a limit or stop order\n8"
+                     "- Cancel an open order\n0"
                      "- Quit")
                 try:
                     selection = int(input("\n"))
@@ -403,13 +779,16 @@ def main():
                              "screener)\n")
 
                             if symbol in symbol_list:
+                                quote_refresher.touch(symbol)
                                 number = input(
                                     f"Enter the number of stock {symbol} you "
                                     f"want to buy: \n")
                                 try:
                                     number = float(number)
                                     if number > 0:
-                                        my_portfolio.buy_stock(symbol, number)
+                                        with profiler.scope("buy"):
+                                            my_portfolio.buy_stock(symbol,
+                                                                   number)
                                     else:
                                         print(
                                             "The number you entered needs to "
@@ -417,17 +796,20 @@ def main():
                                 except ValueError:
                                     print("The value you entered is invalid!")
                             else:
-                                print("The symbol you entered is invalid!")
+                                print_invalid_symbol(symbol, symbol_list)
                         case 2:
                             symbol = input("Enter the stock name: \n")
                             if symbol in symbol_list:
+                                quote_refresher.touch(symbol)
                                 number = input(
                                     f"Enter the number of stock "
                                     f"{symbol} you want to sell: \n")
                                 try:
                                     number = float(number)
                                     if number > 0:
-                                        my_portfolio.sell_stock(symbol, number)
+                                        with profiler.scope("sell"):
+                                            my_portfolio.sell_stock(symbol,
+                                                                    number)
                                     else:
                                         print(
                                             "The number you entered needs to "
@@ -435,7 +817,7 @@ def main():
                                 except ValueError:
                                     print("The value you entered is invalid!")
                             else:
-                                print("The symbol you entered is invalid!")
+                                print_invalid_symbol(symbol, symbol_list)
                         case 3:
                             number = input(
                                 f"How much do you want to increase "
@@ -443,7 +825,9 @@ def main():
                             try:
                                 number = float(number)
                                 if number > 0:
-                                    my_portfolio.increase_investment(number)
+                                    with profiler.scope("increase"):
+                                        my_portfolio.increase_investment(
+                                            number)
                                 else:
                                     print(
                                         "The number you entered needs to be "
@@ -457,24 +841,102 @@ def main():
                             try:
                                 number = float(number)
                                 if number > 0:
-                                    my_portfolio.withdraw(number)
+                                    with profiler.scope("withdraw"):
+                                        my_portfolio.withdraw(number)
                                 else:
                                     print(
                                         "The number you entered needs to be"
                                         " greater than zero!")
                             except ValueError:
                                 print("The value you entered is invalid!")
+                        case 5:
+                            refresh_prices = True
+                            print("The prices of your stocks will be "
+                                  "refreshed.")
+                        case 6:
+                            analytics.print_report(my_portfolio.stock)
+                        case 7:
+                            side = input("Do you want to buy or sell? \n")
+                            kind = input("Is it a limit or a stop order? "
+                                         "\n")
+                            symbol = input("Enter the stock name: \n")
+                            if side not in SIDES or kind not in KINDS:
+                                print("Please enter buy or sell, and limit "
+                                      "or stop!")
+                            elif symbol in symbol_list:
+                                quote_refresher.touch(symbol)
+                                try:
+                                    number = float(input(
+                                        f"Enter the number of stock {symbol}"
+                                        f" you want to {side}: \n"))
+                                    trigger = float(input(
+                                        f"Enter the {kind} price: \n"))
+                                    if number > 0 and trigger > 0:
+                                        with profiler.scope("order"):
+                                            my_portfolio.place_order(
+                                                side, kind, symbol, number,
+                                                trigger)
+                                    else:
+                                        print(
+                                            "The numbers you entered need to "
+                                            "be greater than zero!")
+                                except ValueError:
+                                    print("The value you entered is invalid!")
+                            else:
+                                print_invalid_symbol(symbol, symbol_list)
+                        case 8:
+                            try:
+                                number = int(input(
+                                    "Enter the number of the order you want "
+                                    "to cancel: \n").lstrip("#"))
+                                my_portfolio.cancel_order(number)
+                            except ValueError:
+                                print("The value you entered is invalid!")
                         case 0:
                             errorN = False
+                            quote_refresher.forget(my_portfolio)
+                            write_behind.flush()
+                            end_session()
                             print("Thanks for using our platform!")
                             print("Press any key to continue...")
                             get_key()
                         case _:
-                            print("Please select 1, 2, 3, 4, or 0")
+                            print("Please select 1, 2, 3, 4, 5, 6, 7, 8, "
+                                  "or 0")
                 except ValueError:
                     print(
                         "Error!! Selection is invalid!! Please select one of "
-                        f"the following options only: 1, 2, 3, 4, or 0!")
+                        f"the following options only: 1, 2, 3, 4, 5, 6, 7, "
+                        f"8, or 0!")
 
 
-main()
+def exit_on_signal(signum, frame):
+    """
+    Exit normally when the terminal is closed or the process is terminated,
+    so the pending writes are flushed by the exit handlers.
+    """
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch", metavar="ORDERS",
+                        help="apply a CSV or JSON lines order file headless")
+    parser.add_argument("--report", metavar="REPORT",
+                        help="write the batch results to this CSV file")
+    parser.add_argument("--profile", nargs="?", const=PROFILE_DIR,
+                        metavar="DIR",
+                        help="write per-action profiles to DIR at exit")
+    arguments = parser.parse_args()
+    if arguments.profile:
+        profiler.enable(arguments.profile)
+    if arguments.batch:
+        # batch.py imports this module by name, it must not load it twice.
+        sys.modules.setdefault("run", sys.modules[__name__])
+        import batch
+        batch.run_batch(arguments.batch, arguments.report)
+        sys.exit(0)
+    for signal_name in ("SIGHUP", "SIGTERM"):
+        if hasattr(signal, signal_name):
+            signal.signal(getattr(signal, signal_name), exit_on_signal)
+    main()
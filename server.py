@@ -0,0 +1,217 @@
+"""
+Single-process terminal session server,
+Every TCP connection gets its own session running the `main()` menu flow of
+run.py, all sessions share the quote cache, the symbol index and the
+storage backend of the process.
+
+Usage: python server.py [--host HOST] [--port PORT] [--max-sessions N]
+"""
+import argparse
+import asyncio
+import codecs
+import io
+import os
+import queue
+import signal
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import run
+
+# Maximum number of sessions served at the same time.
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "200"))
+SESSION_HOST = os.getenv("SESSION_HOST", "127.0.0.1")
+SESSION_PORT = int(os.getenv("SESSION_PORT", "8023"))
+
+_local = threading.local()
+
+
+class SessionStream:
+    """
+    Stands in for sys.stdin or sys.stdout and forwards every call to the
+    terminal of the session running in the current thread, or to the
+    original stream outside of sessions.
+    """
+    def __init__(self, fallback):
+        self.fallback = fallback
+
+    def __getattr__(self, name):
+        terminal = getattr(_local, "terminal", None)
+        return getattr(terminal or self.fallback, name)
+
+
+class SessionTerminal:
+    """
+    The terminal of one connection, used from the session's worker thread,
+    - Output is handed to the event loop, which writes it to the socket,
+    - Input characters are fed by the event loop into a queue, lines are
+      echoed and edited here since there is no pty doing it.
+    """
+    encoding = "utf-8"
+    errors = "replace"
+
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+        self.keys = queue.Queue()
+        self.skip_newline = False
+
+    def feed(self, text):
+        for char in text:
+            self.keys.put(char)
+
+    def close(self):
+        self.keys.put(None)
+
+    def write(self, text):
+        data = text.replace("\r\n", "\n").replace("\n", "\r\n")
+        self.loop.call_soon_threadsafe(self.writer.write,
+                                       data.encode(self.encoding))
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+    def fileno(self):
+        raise io.UnsupportedOperation("session terminals have no fileno")
+
+    def clear_screen(self):
+        self.write("\x1b[2J\x1b[H")
+
+    def _next_char(self):
+        """
+        Returns the next input character, skipping the line feed or NUL
+        some clients send after a carriage return,
+        Raises EOFError once the connection is closed.
+        """
+        while True:
+            char = self.keys.get()
+            if char is None:
+                self.keys.put(None)
+                raise EOFError
+            if self.skip_newline and char in "\n\0":
+                self.skip_newline = False
+                continue
+            self.skip_newline = char == "\r"
+            return char
+
+    def get_key(self):
+        return self._next_char()
+
+    def readline(self):
+        """
+        Reads one line with echo and backspace handling, Ctrl-C and Ctrl-D
+        end the session.
+        """
+        chars = []
+        while True:
+            char = self._next_char()
+            if char in "\r\n":
+                self.write("\n")
+                return "".join(chars) + "\n"
+            if char in "\x7f\b":
+                if chars:
+                    chars.pop()
+                    self.write("\b \b")
+            elif char in "\x03\x04":
+                raise EOFError
+            elif char.isprintable():
+                chars.append(char)
+                self.write(char)
+
+
+def run_session(terminal):
+    """
+    Runs the menu flow of run.py for one connection until it is closed.
+    """
+    _local.terminal = terminal
+    try:
+        run.main()
+    except EOFError:
+        pass
+    finally:
+        _local.terminal = None
+
+
+class SessionServer:
+    def __init__(self, max_sessions=MAX_SESSIONS):
+        """
+        Sessions beyond `max_sessions` are turned away with a message, each
+        accepted session runs its menu flow in a worker thread of a pool of
+        the same size.
+        """
+        self.max_sessions = max_sessions
+        self.active = 0
+        self.served = 0
+        self.executor = ThreadPoolExecutor(max_workers=max_sessions,
+                                           thread_name_prefix="session")
+
+    async def handle(self, reader, writer):
+        """
+        Serves one connection, feeding its input to the session terminal
+        until either the client disconnects or the menu flow ends.
+        """
+        if self.active >= self.max_sessions:
+            writer.write(b"The platform is busy, please try again later.\r\n")
+            await writer.drain()
+            writer.close()
+            return
+        self.active += 1
+        self.served += 1
+        loop = asyncio.get_running_loop()
+        terminal = SessionTerminal(loop, writer)
+        session = loop.run_in_executor(self.executor, run_session, terminal)
+        reading = asyncio.ensure_future(self.read_input(reader, terminal))
+        try:
+            try:
+                await asyncio.wait({session, reading},
+                                   return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                # Also when the server is stopping, or the session thread
+                # would wait for input forever and block the exit.
+                terminal.close()
+                reading.cancel()
+            await session
+        finally:
+            self.active -= 1
+            writer.close()
+
+    async def read_input(self, reader, terminal):
+        decoder = codecs.getincrementaldecoder("utf-8")("ignore")
+        while True:
+            data = await reader.read(1024)
+            if not data:
+                return
+            terminal.feed(decoder.decode(data))
+
+
+async def serve(host=SESSION_HOST, port=SESSION_PORT,
+                max_sessions=MAX_SESSIONS):
+    sys.stdin = SessionStream(sys.stdin)
+    sys.stdout = SessionStream(sys.stdout)
+    session_server = SessionServer(max_sessions)
+    server = await asyncio.start_server(session_server.handle, host, port)
+    address = server.sockets[0].getsockname()
+    print(f"Serving sessions on {address[0]}:{address[1]} "
+          f"(max {max_sessions})", flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split(",")[0])
+    parser.add_argument("--host", default=SESSION_HOST)
+    parser.add_argument("--port", type=int, default=SESSION_PORT)
+    parser.add_argument("--max-sessions", type=int, default=MAX_SESSIONS)
+    arguments = parser.parse_args()
+    for signal_name in ("SIGHUP", "SIGTERM"):
+        if hasattr(signal, signal_name):
+            signal.signal(getattr(signal, signal_name), run.exit_on_signal)
+    try:
+        asyncio.run(serve(arguments.host, arguments.port,
+                          arguments.max_sessions))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,943 @@
+import atexit
+import contextlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from jsonstream import CHUNK_SIZE, iter_array, read_chunks, write_array
+from metrics import increment, span, timed
+try:
+    import fcntl
+except ImportError:
+    # Without fcntl (Windows) the files backend only locks within a process.
+    fcntl = None
+try:
+    import env  # only exists locally
+    GITHUB_TOKEN = env.key
+    GIST_ID = env.GIST_ID
+except ImportError:
+    GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
+    GIST_ID = os.getenv("GIST_ID")
+
+# Base URL of the Gist API, can point to a local stand-in server.
+GIST_API_URL = os.getenv("GIST_API_URL", "https://api.github.com")
+
+# Which backend holds the accounts: "gist" (default), "sqlite" or "files".
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "gist")
+# Database file used by the SQLite backend.
+CREDS_DB = os.getenv("CREDS_DB", "creds.db")
+# Directory of the files backend, which keeps one file per account.
+ACCOUNTS_DIR = os.getenv("ACCOUNTS_DIR", "accounts")
+# Number of times a write that lost a compare-and-swap is merged and
+# retried before giving up.
+CAS_RETRIES = int(os.getenv("CAS_RETRIES", "5"))
+# Number of seconds between two flushes of the write-behind queue.
+FLUSH_INTERVAL = float(os.getenv("FLUSH_INTERVAL", "5"))
+# "relaxed" defers every write, "strict" writes money-moving operations
+# synchronously.
+DURABILITY = os.getenv("DURABILITY", "relaxed")
+# Number of accounts read or written at a time by the streaming import,
+# export and iteration.
+STREAM_BATCH = int(os.getenv("STREAM_BATCH", "1000"))
+
+
+class ConflictError(Exception):
+    """
+    Raised when an account could not be written because its stored version
+    kept changing.
+    """
+
+
+class PartialWriteError(Exception):
+    """
+    Raised by compare_and_swap_many when a write failed after some accounts
+    of the batch were written, `versions` and `conflicts` hold the outcome
+    of those accounts as the method would have returned it.
+    """
+    def __init__(self, message, versions, conflicts):
+        super().__init__(message)
+        self.versions = versions
+        self.conflicts = conflicts
+
+
+def _encode(record):
+    """
+    Returns the JSON of an account for the backends that keep its version
+    outside of the record.
+    """
+    return json.dumps({key: value for key, value in record.items()
+                       if key != "version"})
+
+
+class GistStore:
+    """
+    Keeps each account in its own `account-ACCOUNT_ID.json` file of a
+    GitHub Gist,
+    - A write uploads the files of the accounts it changes only, GitHub
+      leaves the other files of the Gist as they are, so sessions writing
+      different accounts never overwrite each other,
+    - The Gist is re-validated with a conditional request on each access and
+      only downloaded again when it changed, each download rebuilds an
+      id -> record index used for lookups, and the next free id is kept in a
+      separate `meta.json` file of the same Gist,
+    - Accounts still in the single `creds.json` file of older Gists are read
+      from it until they are written to their own file,
+    - The Gist API lists at most 300 files of a Gist, larger deployments
+      need the sqlite or files backend.
+    """
+    def __init__(self, gist_id=GIST_ID, token=GITHUB_TOKEN,
+                 api_url=GIST_API_URL):
+        """
+        All requests go through one keep-alive session, the ETag of the last
+        response is kept so unchanged content is not downloaded again,
+        requests is imported here so sessions only load it once they log in.
+        """
+        import requests
+        self.url = f"{api_url}/gists/{gist_id}"
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Authorization": f"token {token}",
+            "Accept": "application/vnd.github+json"
+        })
+        self.etag = None
+        self.index = None
+        self.legacy = False
+        self.max_id = 0
+        self.id_counter = 0
+        # Sessions of the asyncio server share one store between threads.
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def _account_file(account_id):
+        return f"account-{account_id}.json"
+
+    @staticmethod
+    def _files(response):
+        """
+        Returns the files of a Gist API response.
+        """
+        gist = response.json()
+        if gist.get("truncated"):
+            raise RuntimeError("The Gist has more files than the Gist API "
+                               "lists, use the sqlite or files backend")
+        return gist["files"]
+
+    def load_all(self):
+        """
+        Downloads every account from the Gist and rebuilds the id index and
+        the id counter from it,
+        - The request carries the last ETag, on 304 Not Modified the cached
+          accounts are returned,
+        - The content is read inline from the Gist response, the raw URL is
+          only fetched when GitHub truncated a file.
+        """
+        with self.lock:
+            headers = {}
+            if self.etag and self.index is not None:
+                headers["If-None-Match"] = self.etag
+            with span("gist.fetch"):
+                response = self.session.get(self.url, headers=headers)
+            if response.status_code == 304:
+                increment("gist.not_modified")
+                return list(self.index.values())
+            if response.status_code != 200:
+                print("Failed to fetch Gist:", response.status_code)
+                raise RuntimeError(f"Failed to fetch Gist: "
+                                   f"{response.status_code}")
+            return self._apply(response)
+
+    def _sharded(self, files):
+        """
+        Returns the accounts kept in their own files, by id.
+        """
+        return {user["id"]: user for user in (
+            json.loads(self._file_content(file))
+            for name, file in files.items()
+            if name.startswith("account-") and name.endswith(".json"))}
+
+    def _apply(self, response):
+        """
+        Rebuilds the cached accounts, index, id counter and ETag from a Gist
+        API response and returns the accounts.
+        """
+        with span("gist.parse"):
+            files = self._files(response)
+            self.legacy = "creds.json" in files
+            creds = (json.loads(self._file_content(files["creds.json"]))
+                     if self.legacy else [])
+            self.index = {user["id"]: user for user in creds}
+            self.index.update(self._sharded(files))
+        self.max_id = max(map(int, self.index), default=0)
+        if "meta.json" in files:
+            meta = json.loads(self._file_content(files["meta.json"]))
+            self.id_counter = meta["next_id"]
+        self.etag = response.headers.get("ETag")
+        return list(self.index.values())
+
+    def iter_all(self):
+        """
+        Yields every account, from the cache when the Gist did not change,
+        otherwise, when the `creds.json` file of an older Gist is too large
+        to be inlined by GitHub, its accounts are parsed one at a time from
+        the download without building the index.
+        """
+        with self.lock:
+            if self.index is not None:
+                cached = self.load_all()
+            else:
+                response = self._fetch()
+                files = self._files(response)
+                legacy = files.get("creds.json")
+                if legacy is None or self._inline(legacy):
+                    cached = self._apply(response)
+                else:
+                    cached = None
+                    sharded = self._sharded(files)
+        if cached is not None:
+            yield from cached
+            return
+        yield from sharded.values()
+        for user in self._iter_file(legacy):
+            if user["id"] not in sharded:
+                yield user
+
+    def _fetch(self):
+        """
+        Downloads the Gist without touching the cache, GitHub leaves the
+        content of large files to their raw URL.
+        """
+        with span("gist.fetch"):
+            response = self.session.get(self.url)
+        if response.status_code != 200:
+            raise RuntimeError(f"Failed to fetch Gist: "
+                               f"{response.status_code}")
+        return response
+
+    @staticmethod
+    def _inline(file):
+        return not file.get("truncated") and file.get("content") is not None
+
+    def _iter_file(self, file):
+        """
+        Yields the elements of the JSON array in a Gist file, streaming the
+        raw URL when the inline content is missing or truncated.
+        """
+        if self._inline(file):
+            yield from iter_array([file["content"]])
+            return
+        with span("gist.raw_fetch"), self.session.get(
+                file["raw_url"], stream=True) as response:
+            response.raise_for_status()
+            yield from iter_array(response.iter_content(CHUNK_SIZE))
+
+    def _file_content(self, file):
+        """
+        Returns the text of a Gist file, following its raw URL only when the
+        inline content is missing or truncated.
+        """
+        if file.get("truncated") or file.get("content") is None:
+            with span("gist.raw_fetch"):
+                return self.session.get(file["raw_url"]).text
+        return file["content"]
+
+    def save_all(self, creds):
+        """
+        Uploads the list of all accounts to the Gist with a PATCH request,
+        the files of accounts missing from the list and the `creds.json`
+        file of older Gists are deleted.
+        """
+        with self.lock:
+            self.load_all()
+            files = dict.fromkeys(map(self._account_file, self.index))
+            if self.legacy:
+                files["creds.json"] = None
+            files.update((self._account_file(user["id"]), user)
+                         for user in creds)
+            self._patch(files)
+
+    def _patch(self, files):
+        """
+        Writes the given file name -> JSON data pairs to the Gist, a file
+        whose data is None is deleted.
+        """
+        payload = {
+            "files": {
+                name: None if data is None else {"content": json.dumps(data)}
+                for name, data in files.items()
+            }
+        }
+        try:
+            with span("gist.patch"):
+                response = self.session.patch(self.url, json=payload)
+            response.raise_for_status()
+        except Exception:
+            # The Gist may or may not hold the upload, it is downloaded
+            # again in full on the next access.
+            self.etag = None
+            raise
+        # The response holds the whole updated Gist, so the cache is
+        # refreshed from it instead of downloading it again, the cache is
+        # only changed by what the Gist actually stored.
+        self._apply(response)
+
+    def get(self, account_id):
+        """
+        Returns the account with the given id or None, looked up in the index
+        after re-validating the cached Gist,
+        Before anything is cached, as on login, the `creds.json` file of an
+        older Gist too large to be inlined by GitHub is not cached, the
+        account is read from its own file or the accounts of `creds.json`
+        are parsed one at a time until the one asked for.
+        """
+        with self.lock:
+            if self.index is None:
+                response = self._fetch()
+                files = self._files(response)
+                legacy = files.get("creds.json")
+                if legacy is not None and not self._inline(legacy):
+                    file = files.get(self._account_file(account_id))
+                    if file is not None:
+                        return json.loads(self._file_content(file))
+                    for user in self._iter_file(legacy):
+                        if user["id"] == account_id:
+                            return user
+                    return None
+                self._apply(response)
+            else:
+                self.load_all()
+            return self.index.get(account_id)
+
+    def put(self, record):
+        """
+        Inserts the account or replaces the stored account with the same id,
+        The Gist is re-validated first so that the version is raised from
+        the latest stored one.
+        """
+        self.put_many([record])
+
+    def put_many(self, records):
+        """
+        Inserts or replaces several accounts with one conditional download
+        and one upload of their files, the version of each account is
+        raised.
+        """
+        with self.lock:
+            self.load_all()
+            files = {}
+            for record in records:
+                stored = self.index.get(record["id"]) or {}
+                files[self._account_file(record["id"])] = dict(
+                    record, version=stored.get("version", 0) + 1)
+            self._patch(files)
+
+    def compare_and_swap_many(self, records):
+        """
+        Writes each account whose stored version still is the `version` of
+        the record (0 for new accounts), with one conditional download and
+        at most one upload of their files,
+        Returns the new versions by id and the ids of the conflicting
+        accounts,
+        The Gist API has no conditional writes, so the check only covers
+        the changes downloaded just before the upload, two sessions of the
+        same account can still both pass it.
+        """
+        versions = {}
+        conflicts = []
+        with self.lock:
+            self.load_all()
+            files = {}
+            for record in records:
+                stored = self.index.get(record["id"])
+                expected = record.get("version", 0)
+                current = stored.get("version", 0) if stored else 0
+                if current != expected:
+                    conflicts.append(record["id"])
+                    continue
+                files[self._account_file(record["id"])] = dict(
+                    record, version=expected + 1)
+                versions[record["id"]] = expected + 1
+            if files:
+                self._patch(files)
+        return versions, conflicts
+
+    def next_id(self):
+        """
+        Reserves and returns the next unused account id,
+        The counter never goes below the highest stored id, so ids stay
+        unique even when records are reordered,
+        The Gist API has no conditional writes, so two processes reserving
+        an id at the same time can get the same one, the write-behind buffer
+        then refuses to write the second new account over the first one
+        instead of merging them.
+        """
+        with self.lock:
+            self.load_all()
+            new_id = max(self.id_counter, self.max_id) + 1
+            self._patch({"meta.json": {"next_id": new_id}})
+            return new_id
+
+    def close(self):
+        pass
+
+
+class SQLiteStore:
+    """
+    Keeps one row per account in a local SQLite database in WAL mode,
+    The account id is the primary key and each row holds the JSON encoded
+    account record and its version, so lookups and updates touch a single
+    row and compare-and-swap writes are one conditional UPDATE.
+    """
+    def __init__(self, path=CREDS_DB):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS accounts ("
+            "id INTEGER PRIMARY KEY, record TEXT NOT NULL, "
+            "version INTEGER NOT NULL DEFAULT 0)")
+        columns = [row[1] for row in self.connection.execute(
+            "PRAGMA table_info(accounts)")]
+        if "version" not in columns:
+            self.connection.execute("ALTER TABLE accounts ADD COLUMN "
+                                    "version INTEGER NOT NULL DEFAULT 0")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS meta ("
+            "key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self.connection.commit()
+
+    def load_all(self):
+        """
+        Returns the list of all accounts ordered by id.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT record, version FROM accounts ORDER BY id").fetchall()
+        return [dict(json.loads(row[0]), version=row[1]) for row in rows]
+
+    def save_all(self, creds):
+        """
+        Replaces every stored account with the given list in one transaction.
+        """
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM accounts")
+            self.connection.executemany(
+                "INSERT INTO accounts (id, record, version) VALUES (?, ?, ?)",
+                [(user["id"], _encode(user), user.get("version", 0) + 1)
+                 for user in creds])
+
+    def iter_all(self):
+        """
+        Yields every account ordered by id, reading STREAM_BATCH rows at a
+        time.
+        """
+        last = None
+        while True:
+            with self.lock:
+                rows = self.connection.execute(
+                    "SELECT id, record, version FROM accounts WHERE id > ? "
+                    "ORDER BY id LIMIT ?",
+                    (-1 if last is None else last, STREAM_BATCH)).fetchall()
+            for row in rows:
+                yield dict(json.loads(row[1]), version=row[2])
+            if len(rows) < STREAM_BATCH:
+                return
+            last = rows[-1][0]
+
+    @timed("sqlite.get")
+    def get(self, account_id):
+        """
+        Returns the account with the given id or None.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT record, version FROM accounts WHERE id = ?",
+                (account_id,)).fetchone()
+        return dict(json.loads(row[0]), version=row[1]) if row else None
+
+    def put(self, record):
+        """
+        Inserts the account or replaces the stored account with the same id.
+        """
+        self.put_many([record])
+
+    @timed("sqlite.put_many")
+    def put_many(self, records):
+        """
+        Inserts or replaces several accounts in one transaction, the version
+        of each account is raised.
+        """
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT INTO accounts (id, record, version) VALUES (?, ?, 1) "
+                "ON CONFLICT (id) DO UPDATE SET record = excluded.record, "
+                "version = accounts.version + 1",
+                [(record["id"], _encode(record)) for record in records])
+
+    @timed("sqlite.compare_and_swap_many")
+    def compare_and_swap_many(self, records):
+        """
+        Writes each account whose stored version still is the `version` of
+        the record (0 for new accounts) in one transaction, every account is
+        one conditional UPDATE of its own row,
+        Returns the new versions by id and the ids of the conflicting
+        accounts.
+        """
+        versions = {}
+        conflicts = []
+        with self.lock, self.connection:
+            for record in records:
+                expected = record.get("version", 0)
+                cursor = self.connection.execute(
+                    "UPDATE accounts SET record = ?, version = version + 1 "
+                    "WHERE id = ? AND version = ?",
+                    (_encode(record), record["id"], expected))
+                if cursor.rowcount == 0 and expected == 0:
+                    cursor = self.connection.execute(
+                        "INSERT OR IGNORE INTO accounts (id, record, version) "
+                        "VALUES (?, ?, 1)", (record["id"], _encode(record)))
+                if cursor.rowcount:
+                    versions[record["id"]] = expected + 1
+                else:
+                    conflicts.append(record["id"])
+        return versions, conflicts
+
+    def next_id(self):
+        """
+        Reserves and returns the next unused account id,
+        The persisted counter never goes below the highest stored id, which
+        the primary key index returns without scanning the table,
+        The counter is read and bumped in one IMMEDIATE transaction, which
+        takes the database write lock first, so two processes never read the
+        same counter.
+        """
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            counter = self.connection.execute(
+                "SELECT value FROM meta WHERE key = 'next_id'").fetchone()
+            max_id = self.connection.execute(
+                "SELECT MAX(id) FROM accounts").fetchone()[0]
+            new_id = max(counter[0] if counter else 0, max_id or 0) + 1
+            self.connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) "
+                "VALUES ('next_id', ?)", (new_id,))
+        return new_id
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class FileStore:
+    """
+    Keeps each account in its own JSON file `ACCOUNT_ID.json`, with its
+    version inside the record,
+    Writes take the lock file of the account only, and replace the account
+    file atomically, so sessions of different accounts never touch the same
+    file.
+    """
+    def __init__(self, directory=ACCOUNTS_DIR):
+        self.directory = directory
+        # lock file name -> lock of the threads of this process, guarded by
+        # `lock`, threads writing different accounts never wait on each other.
+        self.locks = {}
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    @contextlib.contextmanager
+    def _locked(self, name):
+        """
+        Holds the lock file `name` exclusively, against the other threads
+        through its own lock and against the other processes with flock.
+        """
+        with self.lock:
+            lock = self.locks.setdefault(name, threading.Lock())
+        with lock, open(self._path(name), "a") as file:
+            if fcntl is not None:
+                fcntl.flock(file, fcntl.LOCK_EX)
+            yield file
+
+    def load_all(self):
+        """
+        Returns the list of all accounts ordered by id.
+        """
+        return list(self.iter_all())
+
+    def iter_all(self):
+        """
+        Yields every account ordered by id, one file at a time.
+        """
+        ids = sorted(int(name[:-5]) for name in os.listdir(self.directory)
+                     if name.endswith(".json") and name[:-5].isdigit())
+        for record in map(self.get, ids):
+            if record is not None:
+                yield record
+
+    def save_all(self, creds):
+        """
+        Writes every account of the list, accounts missing from the list are
+        left in place.
+        """
+        self.put_many(creds)
+
+    def get(self, account_id):
+        """
+        Returns the account with the given id or None.
+        """
+        try:
+            with open(self._path(f"{account_id}.json"), "r") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def _write(self, record):
+        path = self._path(f"{record['id']}.json")
+        with open(path + ".tmp", "w") as file:
+            json.dump(record, file)
+        os.replace(path + ".tmp", path)
+
+    def put(self, record):
+        """
+        Inserts the account or replaces the stored account with the same id.
+        """
+        self.put_many([record])
+
+    def put_many(self, records):
+        """
+        Inserts or replaces several accounts, the version of each account is
+        raised.
+        """
+        for record in records:
+            with self._locked(f"{record['id']}.lock"):
+                stored = self.get(record["id"]) or {}
+                self._write(dict(record,
+                                 version=stored.get("version", 0) + 1))
+
+    def compare_and_swap_many(self, records):
+        """
+        Writes each account whose stored version still is the `version` of
+        the record (0 for new accounts), under the lock of that account only,
+        Returns the new versions by id and the ids of the conflicting
+        accounts,
+        Each account is its own write, a failure after some of them were
+        written raises PartialWriteError with their new versions.
+        """
+        versions = {}
+        conflicts = []
+        for record in records:
+            expected = record.get("version", 0)
+            try:
+                with self._locked(f"{record['id']}.lock"):
+                    stored = self.get(record["id"])
+                    if (stored or {}).get("version", 0) != expected:
+                        conflicts.append(record["id"])
+                        continue
+                    self._write(dict(record, version=expected + 1))
+            except Exception as error:
+                if not versions:
+                    raise
+                raise PartialWriteError(
+                    f"Account {record['id']} could not be written: {error}",
+                    versions, conflicts) from error
+            versions[record["id"]] = expected + 1
+        return versions, conflicts
+
+    def next_id(self):
+        """
+        Reserves and returns the next unused account id from the persisted
+        counter, which never goes below the highest stored id, the account
+        files are listed on every call since records written by other means
+        (restored or copied files) do not bump the counter.
+        """
+        with self._locked("next_id.lock"):
+            try:
+                with open(self._path("next_id"), "r") as file:
+                    counter = int(file.read())
+            except (FileNotFoundError, ValueError):
+                counter = 0
+            max_id = max((int(name[:-5]) for name
+                          in os.listdir(self.directory)
+                          if name.endswith(".json") and
+                          name[:-5].isdigit()), default=0)
+            new_id = max(counter, max_id) + 1
+            with open(self._path("next_id"), "w") as file:
+                file.write(str(new_id))
+        return new_id
+
+    def close(self):
+        pass
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """
+    Returns the process-wide store selected by the STORAGE_BACKEND
+    environment variable, creating it on first use.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            if STORAGE_BACKEND == "sqlite":
+                _store = SQLiteStore()
+            elif STORAGE_BACKEND == "files":
+                _store = FileStore()
+            else:
+                _store = GistStore()
+    return _store
+
+
+def merge_events(stored, record, events):
+    """
+    Returns the record to write after a conflict and the operations dropped
+    from it: the stored account with the operations of this session
+    (`events`) applied on top of it, each checked again against the merged
+    balances and holdings (see ledger.apply_checked), or the session's
+    record when the account is not stored anymore,
+    Operations the stored record already includes, as a ledger compaction
+    may have replayed them into it, are skipped, orders numbered like one
+    of the stored account are renumbered, the dropped operations carry the
+    `reason` they were dropped.
+    """
+    from ledger import already_applied, apply_checked
+    if stored is None:
+        return dict(record, version=0), []
+    merged = dict(stored, stock=dict(stored["stock"]))
+    rejected = []
+    renumbered = {}
+    for event in events:
+        if already_applied(merged, event):
+            continue
+        reason = apply_checked(merged, event, renumbered)
+        if reason is not None:
+            rejected.append(dict(event, reason=reason))
+    return merged, rejected
+
+
+class WriteBehind:
+    """
+    Coalesces account writes in memory and flushes them to the store,
+    - Only the latest record of each account is kept, together with every
+      operation made since the account was last written,
+    - Records are written with compare-and-swap on the version they were
+      read at, an account that changed in the meantime is read again on its
+      own, the pending operations are applied to it and it is retried,
+    - The pending records are written every `interval` seconds, on request
+      and at process exit.
+    """
+    def __init__(self, interval=FLUSH_INTERVAL):
+        self.interval = interval
+        # (account id, owner) -> [record, operations, owner], sessions
+        # sharing an account keep their own entries so that neither
+        # overwrites the operations of the other.
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                # The records were put back and are retried next interval.
+                pass
+
+    def schedule(self, record, events=(), owner=None):
+        """
+        Marks the account dirty, replacing any record of the same owner still
+        waiting for the same id and adding `events` to its operations, and
+        starts the background flusher on first use,
+        `owner` is told the new version with
+        `stored(version, written, merged, rejected)`, `written` being the
+        operations written, `merged` the written record when it was merged
+        with changes made elsewhere, None otherwise, and `rejected` the
+        operations the merge dropped, or with
+        `not_stored(reason)` when the record of a new account could not be
+        written because its id is taken.
+        """
+        key = (record["id"], owner)
+        with self.lock:
+            entry = self.pending.get(key)
+            if entry is None:
+                self.pending[key] = [record, list(events), owner]
+            else:
+                entry[0] = record
+                entry[1].extend(events)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def write_now(self, account_id, owner=None):
+        """
+        Writes the record of the account waiting for `owner` synchronously,
+        together with its pending operations, once any write in progress is
+        done,
+        Callers queue the record with `schedule` first, under their own
+        lock, so that records and operations are written in the order they
+        were made even when several threads save the same portfolio.
+        """
+        key = (account_id, owner)
+        with self.flush_lock:
+            with self.lock:
+                entry = self.pending.pop(key, None)
+            if entry is not None:
+                self._write({key: entry})
+
+    @timed("write_behind.flush")
+    def flush(self):
+        """
+        Writes every pending record to the store in one batch.
+        """
+        with self.flush_lock:
+            with self.lock:
+                entries = self.pending
+                self.pending = {}
+            if entries:
+                self._write(entries)
+
+    def _write(self, entries):
+        """
+        Writes the entries with compare-and-swap, one entry per account in
+        each batch, merging and retrying the conflicting accounts up to
+        CAS_RETRIES times,
+        Entries that could not be written are put back before raising.
+        """
+        store = get_store()
+        try:
+            while entries:
+                batch = {}
+                for key in entries:
+                    batch.setdefault(key[0], key)
+                self._write_batch(store, entries, batch)
+        except Exception:
+            with self.lock:
+                for key, entry in entries.items():
+                    newer = self.pending.get(key)
+                    if newer is None:
+                        self.pending[key] = entry
+                    else:
+                        newer[1][:0] = entry[1]
+            raise
+
+    def _write_batch(self, store, entries, batch):
+        """
+        Writes the entries of `batch` (account id -> key of `entries`) and
+        removes them from `entries` once written.
+        """
+        # account id -> operations dropped by the last merge
+        merged = {}
+        for attempt in range(CAS_RETRIES + 1):
+            try:
+                versions, conflicts = store.compare_and_swap_many(
+                    [entries[key][0] for key in batch.values()])
+            except PartialWriteError as error:
+                # The written accounts are not put back, their operations
+                # would be merged a second time.
+                self._stored(entries, batch, merged, error.versions)
+                raise
+            self._stored(entries, batch, merged, versions)
+            if not conflicts:
+                return
+            increment("storage.conflicts", len(conflicts))
+            for account_id in conflicts:
+                entry = entries[batch[account_id]]
+                if entry[0].get("version", 0) == 0:
+                    self._drop_new(entries, batch, account_id)
+                    continue
+                entry[0], merged[account_id] = merge_events(
+                    store.get(account_id), entry[0], entry[1])
+        raise ConflictError(f"Accounts {sorted(batch)} kept changing")
+
+    def _stored(self, entries, batch, merged, versions):
+        """
+        Removes the written accounts from `entries` and `batch` and tells
+        their owners the new versions.
+        """
+        for account_id, version in versions.items():
+            record, events, owner = entries.pop(batch.pop(account_id))
+            if owner is None:
+                continue
+            if account_id in merged:
+                owner.stored(version, events, record, merged[account_id])
+            else:
+                owner.stored(version, events, None, [])
+
+    def _drop_new(self, entries, batch, account_id):
+        """
+        Gives up on a new account whose id turned out to be taken by another
+        account, it is never merged into it,
+        The owner is told with `not_stored(reason)`.
+        """
+        record, events, owner = entries.pop(batch.pop(account_id))
+        increment("storage.ids_taken")
+        reason = f"the id {account_id} is taken by another account"
+        if owner is None:
+            raise ConflictError(f"New account {account_id}: {reason}")
+        owner.not_stored(reason)
+
+
+write_behind = WriteBehind()
+
+
+def _batches(records, size=STREAM_BATCH):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_creds(store, path="creds.json"):
+    """
+    Copies every account of a `creds.json` file into the given store,
+    The file is parsed and written STREAM_BATCH accounts at a time,
+    Returns the number of imported accounts.
+    """
+    count = 0
+    with open(path, "rb") as file:
+        for batch in _batches(iter_array(read_chunks(file))):
+            store.put_many(batch)
+            count += len(batch)
+    return count
+
+
+def export_creds(store, path="creds.json"):
+    """
+    Writes every account of the given store to a `creds.json` file, one
+    account at a time, without the store's versions,
+    Returns the number of exported accounts.
+    """
+    records = ({key: value for key, value in record.items()
+                if key != "version"} for record in store.iter_all())
+    with open(path, "w") as file:
+        return write_array(records, file)
+
+
+if __name__ == "__main__":
+    # One-shot copies: python storage.py import|export [creds.json] [creds.db]
+    if len(sys.argv) < 2 or sys.argv[1] not in ("import", "export"):
+        print("Usage: python storage.py import|export [creds.json] "
+              "[creds.db]")
+        sys.exit(1)
+    path = sys.argv[2] if len(sys.argv) > 2 else "creds.json"
+    database = sys.argv[3] if len(sys.argv) > 3 else CREDS_DB
+    if sys.argv[1] == "import":
+        count = import_creds(SQLiteStore(database), path)
+        print(f"Imported {count} accounts from {path} into {database}.")
+    else:
+        count = export_creds(SQLiteStore(database), path)
+        print(f"Exported {count} accounts from {database} into {path}.")
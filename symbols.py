@@ -0,0 +1,119 @@
+import json
+import marshal
+import os
+import sys
+from bisect import bisect_left
+from metrics import timed
+
+# JSON list of every tradable symbol.
+SYMBOL_FILE = "stock_list.txt"
+# Precompiled copy of SYMBOL_FILE, rebuilt whenever the JSON file is newer.
+SYMBOL_INDEX_FILE = "stock_list.idx"
+
+
+class SymbolIndex:
+    """
+    Sorted, de-duplicated stock symbols with O(1) membership tests and
+    binary-search prefix lookups.
+    """
+    def __init__(self, symbols):
+        self.sorted = tuple(sorted(set(symbols)))
+        self.members = frozenset(self.sorted)
+
+    def __contains__(self, symbol):
+        return symbol in self.members
+
+    def __len__(self):
+        return len(self.sorted)
+
+    def __iter__(self):
+        return iter(self.sorted)
+
+    def prefix(self, text, limit=None):
+        """
+        Returns the symbols starting with `text` in alphabetical order,
+        at most `limit` of them when a limit is given.
+        """
+        start = bisect_left(self.sorted, text)
+        matches = []
+        for symbol in self.sorted[start:]:
+            if not symbol.startswith(text):
+                break
+            matches.append(symbol)
+            if limit is not None and len(matches) == limit:
+                break
+        return matches
+
+    def intern(self, symbol):
+        """
+        Returns the index's own copy of the symbol, or the interned string
+        for unknown symbols, so loaded accounts share one string per symbol
+        instead of keeping the copies decoded from their JSON.
+        """
+        position = bisect_left(self.sorted, symbol)
+        if position < len(self.sorted) and self.sorted[position] == symbol:
+            return self.sorted[position]
+        return sys.intern(symbol)
+
+    def suggest(self, text, limit=5):
+        """
+        Returns up to `limit` known symbols close to what the user typed,
+        - The input is upper-cased and stripped,
+        - Symbols sharing the longest possible prefix with it are returned,
+          shortening the prefix one character at a time until something
+          matches.
+        """
+        text = text.strip().upper()
+        while text:
+            matches = self.prefix(text, limit)
+            if matches:
+                return matches
+            text = text[:-1]
+        return []
+
+
+def build_symbol_index(source=SYMBOL_FILE, target=SYMBOL_INDEX_FILE):
+    """
+    Parses the JSON symbol list and writes the precompiled index file,
+    Returns the new SymbolIndex.
+    """
+    with open(source, "r") as file:
+        index = SymbolIndex(json.load(file))
+    try:
+        with open(target, "wb") as file:
+            marshal.dump(index.sorted, file)
+    except OSError:
+        # A read-only deployment still works, it just parses the JSON.
+        pass
+    return index
+
+
+@timed("symbols.load")
+def load_symbol_index(source=SYMBOL_FILE, target=SYMBOL_INDEX_FILE):
+    """
+    Loads the symbol index from the precompiled file when it is up to date
+    with the JSON list, otherwise rebuilds it.
+    """
+    try:
+        if os.path.getmtime(target) >= os.path.getmtime(source):
+            with open(target, "rb") as file:
+                index = SymbolIndex.__new__(SymbolIndex)
+                index.sorted = marshal.loads(file.read())
+                index.members = frozenset(index.sorted)
+                return index
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    return build_symbol_index(source, target)
+
+
+_symbol_index = None
+
+
+def get_symbol_index():
+    """
+    Returns the process-wide symbol index, loading it on first use.
+    """
+    global _symbol_index
+    if _symbol_index is None:
+        _symbol_index = load_symbol_index()
+    return _symbol_index